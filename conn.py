@@ -48,7 +48,7 @@ async def main():
     )
     qmi = QmiManager(args.modem_dev, modem.is_running_event)
 
-    with qmi.alloc_voice_cid():
+    async with qmi.alloc_voice_cid():
         tasks = [modem.run()] + ([qmi.network_task()] if args.network else [])
         await asyncio.gather(*tasks)
 
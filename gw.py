@@ -3,23 +3,62 @@ import asyncio
 import logging
 import argparse
 import functools
+import contextlib
 
 from qmi import QmiManager
-from sip import SIPClient, SIPCallForwarder, SIPSmsForwarder
+from sip import SIPClient, SIPCallForwarder, SIPSmsForwarder, SIP_GROUP_TIMEOUT
 from tg import TgForwarder
+from outbox import SmsOutbox
+from pipeline import ForwardingPipeline, OutboxSink, TgSink, WebhookSink, JsonlSink, \
+    SmsCoalescer, EVENT_MISSED_CALL
+from plmncache import PlmnCache
+from smsapi import SmsApi
+from startup import StartupOrchestrator
 from quectelmodem import QuectelModemManager
+from modempool import ModemPool, ModemLine, line_identity, DEFAULT_LINE_NAME
 
 
 logger = logging.getLogger('GsmGw')
 
 
+def parse_modem(value):
+    '''
+    tty=<AT TTY>,dev=<QMI device>[,card=<audio device>][,pin=..][,apn=..][,name=..][,prefix=..]
+    '''
+    try:
+        modem = dict(kv.split('=', 1) for kv in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected key=value pairs: %r' % (value, ))
+    if 'tty' not in modem or 'dev' not in modem:
+        raise argparse.ArgumentTypeError('tty= and dev= are required: %r' % (value, ))
+    return modem
+
+
 def parse_cmdline():
     parser = argparse.ArgumentParser(description='GSM to SIP Gateway')
-    parser.add_argument('--sip_dest', help='Target SIP URI', required=True)
+    parser.add_argument('--sip_dest', help='Target SIP URI. Comma separated URIs ring in '
+                        'parallel, repeat for groups that ring one after the other',
+                        action='append', required=True)
+    parser.add_argument('--sip_group_timeout', help='Ringing timeout of each --sip_dest group. '
+                        'Defaults to --call_timeout with a single group, else %d' % (
+                            SIP_GROUP_TIMEOUT, ), type=int, default=None)
+    parser.add_argument('--sip_msg_window', help='Max SIP MESSAGEs in flight at once',
+                        type=int, default=8)
     parser.add_argument('--tg_bot', help='Backup TG bot auth', required=False)
     parser.add_argument('--tg_chat', help='Backup TG chat ID', required=False)
-    parser.add_argument('--modem_tty', help='TTY device of the modem for AT', required=True)
-    parser.add_argument('--modem_dev', help='Modem device for QMI', required=True)
+    parser.add_argument('--tg_api', help='Base URL of the TG bot API',
+                        default='https://api.telegram.org')
+    parser.add_argument('--tg_always', help='Forward everything to TG, not just SIP failures',
+                        type=bool, default=False)
+    parser.add_argument('--webhook', help='Also POST every SMS/missed call here as JSON',
+                        default=None)
+    parser.add_argument('--jsonl', help='Also append every SMS/missed call to this file',
+                        default=None)
+    parser.add_argument('--modem_tty', help='TTY device of the modem for AT', default=None)
+    parser.add_argument('--modem_dev', help='Modem device for QMI', default=None)
+    parser.add_argument('--modem', help='A modem of the pool, as tty=..,dev=..[,card=..]'
+                        '[,pin=..][,apn=..][,name=..][,prefix=..]. Repeat for more modems',
+                        type=parse_modem, action='append', default=[])
     parser.add_argument('--call_timeout', help='Timeout for ringing before hangup',
                         type=int, default=90)
     parser.add_argument('--sim_pin', help='SIM card PIN', default=None)
@@ -27,10 +66,76 @@ def parse_cmdline():
     parser.add_argument('--local_country_code', help='E.g. +972, to remove from caller ID',
                         default=None)
     parser.add_argument('--network', help='Start QMI network', type=bool, default=False)
+    parser.add_argument('--network_ipv6', help='Also start an IPv6 QMI network session',
+                        type=bool, default=False)
     parser.add_argument('--disregard_volte', help='Ignore if VoLTE is unavaliable',
                         type=bool, default=False)
     parser.add_argument('--apn', help='APN', default=None, required=False)
-    return parser.parse_args()
+    parser.add_argument('--outbox', help='Path of the on-disk SMS outbox',
+                        default='sms_outbox.db')
+    parser.add_argument('--plmn_cache', help='Path of the last known good network cache',
+                        default='plmn_cache.json')
+    parser.add_argument('--warm_start', help='Skip the full modem reset when its '
+                        'configuration checks out', type=bool, default=False)
+    parser.add_argument('--sms_coalesce', help='Seconds to collect SMS into one digest '
+                        'MESSAGE (0 to send each one)', type=float, default=0)
+    parser.add_argument('--sms_coalesce_max', help='Max SMS in one digest MESSAGE',
+                        type=int, default=10)
+    parser.add_argument('--sms_coalesce_global', help='Coalesce across senders, too',
+                        type=bool, default=False)
+    parser.add_argument('--sms_api', help='host:port or unix socket path to serve the '
+                        'outgoing SMS and status API on', default=None)
+    parser.add_argument('--sip_sms_in', help='Send MESSAGEs to sip:<number>@... as SMS',
+                        type=bool, default=False)
+    parser.add_argument('--sip_calls_in', help='Dial out calls to sip:gsm@<this host> '
+                        'to the number in their To header', type=bool, default=False)
+    parser.add_argument('--direct_sms', help='Get SMS as +CMT, bypassing modem storage',
+                        type=bool, default=False)
+    args = parser.parse_args()
+
+    if args.sip_group_timeout is None:
+        args.sip_group_timeout = args.call_timeout if len(args.sip_dest) == 1 \
+            else SIP_GROUP_TIMEOUT
+
+    if not args.modem:
+        if not args.modem_tty or not args.modem_dev:
+            parser.error('Either --modem, or --modem_tty and --modem_dev are required')
+        args.modem = [{'tty': args.modem_tty, 'dev': args.modem_dev, 'pin': args.sim_pin}]
+    return args
+
+
+def create_line(args, index, modem, sip, pipeline, plmn_cache):
+    name = modem.get('name') or (
+        DEFAULT_LINE_NAME if index == 0 else '%s%d' % (DEFAULT_LINE_NAME, index + 1)
+    )
+    identity = functools.partial(line_identity, name)
+
+    def call_fwd(number, connected_cb, ended_cb):
+        return SIPCallForwarder(
+            sip, identity(number), connected_cb, ended_cb,
+            call_timeout=args.call_timeout,
+            group_timeout=args.sip_group_timeout,
+            missed_call_fwd=functools.partial(pipeline.forwarder, kind=EVENT_MISSED_CALL),
+            audio_device=modem.get('card'),
+        )
+
+    def sms_fwd(number, text):
+        return pipeline.forwarder(identity(number), text)
+
+    modem_manager = QuectelModemManager(
+        modem['tty'],
+        call_forwarder=call_fwd,
+        sms_forwarder=sms_fwd,
+        sim_card_pin=modem.get('pin', args.sim_pin),
+        preferred_network=args.preferred_network,
+        disregard_volte=args.disregard_volte,
+        apn=modem.get('apn', args.apn),
+        direct_sms=args.direct_sms,
+        plmn_cache=plmn_cache,
+        warm_start=args.warm_start,
+    )
+    qmi = QmiManager(modem['dev'], modem_manager.is_running_event)
+    return ModemLine(name, modem_manager, qmi, modem.get('card'), modem.get('prefix'))
 
 
 async def main():
@@ -40,34 +145,71 @@ async def main():
 
     tg_fwd = None
     if args.tg_bot:
-        tg_fwd = TgForwarder(args.tg_bot, args.tg_chat)
+        tg_fwd = TgForwarder(args.tg_bot, args.tg_chat, args.tg_api)
 
-    sip = SIPClient(args.local_country_code, tg_fwd)
+    # With --tg_always TG is a sink of its own, otherwise it's the SIP fallback
+    sip = SIPClient(args.local_country_code, None if args.tg_always else tg_fwd,
+                    msg_window=args.sip_msg_window)
 
-    with sip.context(args.sip_dest):
+    with sip.context([dest.split(',') for dest in args.sip_dest]):
         logger.info('Created SIP client')
 
-        call_fwd = functools.partial(
-            SIPCallForwarder, sip, call_timeout=args.call_timeout
-        )
-
         sms_fwd = functools.partial(SIPSmsForwarder, sip)
-
-        modem_manager = QuectelModemManager(
-            args.modem_tty,
-            call_forwarder=call_fwd,
-            sms_forwarder=sms_fwd,
-            sim_card_pin=args.sim_pin,
-            preferred_network=args.preferred_network,
-            disregard_volte=args.disregard_volte,
-            apn=args.apn,
-        )
-
-        qmi = QmiManager(args.modem_dev, modem_manager.is_running_event)
-        with qmi.alloc_voice_cid():
-            tasks = [modem_manager.run()]
-            if args.network:
-                tasks.append(qmi.network_task())
+        coalescer = None
+        if args.sms_coalesce:
+            coalescer = SmsCoalescer(sms_fwd, args.sms_coalesce, args.sms_coalesce_max,
+                                     per_sender=not args.sms_coalesce_global)
+            sms_fwd = coalescer.forwarder
+        outbox = SmsOutbox(args.outbox, sms_fwd)
+
+        pipeline = ForwardingPipeline()
+        pipeline.add_sink(OutboxSink(outbox))
+        if tg_fwd and args.tg_always:
+            pipeline.add_sink(TgSink(tg_fwd))
+        if args.webhook:
+            pipeline.add_sink(WebhookSink(args.webhook))
+        if args.jsonl:
+            pipeline.add_sink(JsonlSink(args.jsonl))
+
+        # All the modems share the SIP stack, the outbox and the PLMN cache
+        plmn_cache = PlmnCache(args.plmn_cache)
+        pool = ModemPool()
+        for index, modem in enumerate(args.modem):
+            pool.add(create_line(args, index, modem, sip, pipeline, plmn_cache))
+
+        async with contextlib.AsyncExitStack() as stack:
+            if coalescer:
+                stack.push_async_callback(coalescer.close)
+
+            async def qmi_startup(line):
+                modem_manager = line.modem_manager
+                await stack.enter_async_context(line.qmi.alloc_voice_cid())
+                await line.qmi.follow_calls(modem_manager.incoming_call,
+                                            modem_manager.remote_hangup,
+                                            modem_manager.call_progress)
+
+            startup = StartupOrchestrator()
+            startup.add_phase('sip', sip.wait_started())
+            for line in pool:
+                startup.add_phase('qmi:%s' % (line.name, ), qmi_startup(line))
+                startup.add_phase('modem:%s' % (line.name, ),
+                                  line.modem_manager.is_running_event.wait())
+
+            tasks = [startup.run(), outbox.run(), pipeline.run(), sip.keepalive_task()]
+            for line in pool:
+                tasks.append(line.modem_manager.run())
+                if args.network:
+                    tasks.append(line.qmi.network_task(
+                        ('ipv4', 'ipv6') if args.network_ipv6 else ('ipv4', )
+                    ))
+            if tg_fwd:
+                tasks.append(tg_fwd.run())
+            if args.sms_api:
+                tasks.append(SmsApi(pool, args.sms_api, pool.status).run())
+            if args.sip_sms_in:
+                sip.accept_messages(pool.send_sms)
+            if args.sip_calls_in:
+                tasks.append(sip.accept_calls(pool.dial))
 
             await asyncio.gather(*tasks)
 
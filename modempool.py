@@ -0,0 +1,94 @@
+import logging
+
+
+DEFAULT_LINE_NAME = 'gsm'
+# A call keeps a modem busier than any queue of SMS
+CALL_LOAD = 1000
+
+logger = logging.getLogger('ModemPool')
+
+
+def line_identity(name, number):
+    # The single line setup keeps the plain numbers
+    if name == DEFAULT_LINE_NAME:
+        return number
+    return '%s@%s' % (number, name)
+
+
+class ModemLine:
+    '''
+    One modem with its SIM, QMI channel and ALSA card. Its name is the domain
+    of the SIP identities its callers get
+    '''
+    def __init__(self, name, modem_manager, qmi, audio_device=None, prefix=None):
+        self.name = name
+        self.modem_manager = modem_manager
+        self.qmi = qmi
+        self.audio_device = audio_device
+        self.prefix = prefix
+
+    @property
+    def load(self):
+        modem = self.modem_manager
+        return modem.outgoing_sms_queued + (CALL_LOAD if modem.in_call else 0)
+
+
+class ModemPool:
+    '''
+    Spreads outbound SMS and calls over the lines. Lines whose prefix matches
+    the number go first, then the least loaded one wins
+    '''
+    def __init__(self):
+        self._lines = []
+
+    def add(self, line):
+        self._lines.append(line)
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def _candidates(self, number):
+        lines = [line for line in self._lines if line.modem_manager.is_running_event.is_set()]
+        return sorted(lines, key=lambda line: (
+            not (line.prefix and number.startswith(line.prefix)), line.load
+        ))
+
+    def send_sms(self, number, text, status_report=False):
+        lines = self._candidates(number)
+        if not lines:
+            raise LookupError('No modem is up')
+        logger.info('Sending SMS to %s through %s' % (number, lines[0].name))
+        return lines[0].modem_manager.send_sms(number, text, status_report)
+
+    def get_sent_sms(self, sms_id):
+        for line in self._lines:
+            outgoing = line.modem_manager.get_sent_sms(sms_id)
+            if outgoing:
+                return outgoing
+        return None
+
+    def status(self):
+        return {
+            line.name: {
+                'up': line.modem_manager.is_running_event.is_set(),
+                'in_call': line.modem_manager.in_call,
+                'outgoing_sms_queued': line.modem_manager.outgoing_sms_queued,
+                'urc_latency_max': line.modem_manager.urc_latency_max,
+                'network': line.qmi.network_counters,
+            }
+            for line in self._lines
+        }
+
+    def dial(self, number, progress_cb, busy_devices=()):
+        '''
+        Returns (call task, audio device) of the line dialing, skipping lines
+        whose audio device is in another call
+        '''
+        for line in self._candidates(number):
+            if line.modem_manager.in_call or line.audio_device in busy_devices:
+                continue
+            call_task = line.modem_manager.dial(number, progress_cb)
+            if call_task:
+                logger.info('Dialing %s through %s' % (number, line.name))
+                return call_task, line.audio_device
+        return None
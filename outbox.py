@@ -0,0 +1,112 @@
+import time
+import asyncio
+import logging
+import sqlite3
+import concurrent.futures
+
+
+OUTBOX_BATCH = 16
+OUTBOX_RETRY_MIN = 5
+OUTBOX_RETRY_MAX = 10 * 60
+
+logger = logging.getLogger('SmsOutbox')
+
+
+class SmsOutbox:
+    '''
+    Crash-safe SQLite (WAL) queue between the modem and the SMS forwarder.
+    An SMS handed to forwarder() is on disk once send() returns
+    '''
+    def __init__(self, path, sms_forwarder):
+        self._path = path
+        self._sms_forwarder = sms_forwarder
+        # sqlite is blocking, so all DB work happens on this single thread
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._db = None
+        # The first job of the executor, so every DB call runs after it
+        self._opened = self._executor.submit(self._open)
+        self._wakeup = asyncio.Event()
+
+    def _open(self):
+        self._db = sqlite3.connect(self._path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY, number TEXT, '
+            'text TEXT, attempts INTEGER DEFAULT 0, next_try REAL)'
+        )
+        self._db.commit()
+
+    async def _db_call(self, func, *args):
+        await asyncio.wrap_future(self._opened)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _insert(self, number, text):
+        with self._db:
+            self._db.execute('INSERT INTO outbox (number, text, next_try) VALUES (?, ?, ?)',
+                             (number, text, time.time()))
+
+    def _due(self, now):
+        return self._db.execute(
+            'SELECT id, number, text, attempts FROM outbox WHERE next_try <= ? '
+            'ORDER BY id LIMIT ?', (now, OUTBOX_BATCH)
+        ).fetchall()
+
+    def _next_try(self):
+        return self._db.execute('SELECT MIN(next_try) FROM outbox').fetchone()[0]
+
+    def _done(self, sent, failed):
+        with self._db:
+            self._db.executemany('DELETE FROM outbox WHERE id = ?', [(i, ) for i in sent])
+            self._db.executemany('UPDATE outbox SET attempts = ?, next_try = ? WHERE id = ?',
+                                 failed)
+
+    async def put(self, number, text):
+        await self._db_call(self._insert, number, text)
+        self._wakeup.set()
+
+    def forwarder(self, number, text):
+        outbox = self
+
+        class Cls:
+            async def send(self):
+                await outbox.put(number, text)
+        return Cls()
+
+    def _retry_delay(self, attempts):
+        return min(OUTBOX_RETRY_MIN * 2 ** attempts, OUTBOX_RETRY_MAX)
+
+    async def _drain_batch(self, rows):
+        sent, failed = [], []
+        # The forwarder bounds how many of these are actually in flight
+        results = await asyncio.gather(*[
+            self._sms_forwarder(number, text).send() for _, number, text, _ in rows
+        ], return_exceptions=True)
+
+        for (row_id, number, text, attempts), res in zip(rows, results):
+            if isinstance(res, Exception):
+                delay = self._retry_delay(attempts)
+                logger.warning('SMS from %s not delivered, retry in %ds: %r' % (
+                    number, delay, res
+                ))
+                failed.append((attempts + 1, time.time() + delay, row_id))
+            else:
+                sent.append(row_id)
+
+        await self._db_call(self._done, sent, failed)
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            rows = await self._db_call(self._due, time.time())
+            if rows:
+                logger.info('Draining %d SMS from outbox' % (len(rows), ))
+                await self._drain_batch(rows)
+                continue
+
+            next_try = await self._db_call(self._next_try)
+            timeout = None if next_try is None else max(next_try - time.time(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.exceptions.TimeoutError:
+                pass
@@ -0,0 +1,292 @@
+import abc
+import json
+import time
+import asyncio
+import logging
+import requests
+import threading
+import collections
+import concurrent.futures
+
+
+PIPELINE_RETRY_MIN = 1
+WEBHOOK_HTTP_TIMEOUT = 10
+COALESCE_WINDOW = 2
+COALESCE_MAX_MSGS = 10
+COALESCE_DIGEST_SENDER = 'digest'
+
+EVENT_SMS = 'sms'
+EVENT_MISSED_CALL = 'missed_call'
+
+Event = collections.namedtuple('Event', ('kind', 'number', 'text', 'time'))
+
+logger = logging.getLogger('Pipeline')
+
+
+class Sink(abc.ABC):
+    '''
+    Somewhere events get forwarded to. The class attributes are the defaults
+    of the sink's queue and failure policy.
+    A durable sink holds up send() until it has the event, and gets
+    backpressure instead of drops when its queue is full
+    '''
+    name = 'sink'
+    queue_size = 64
+    concurrency = 1
+    retries = 3
+    durable = False
+
+    @abc.abstractmethod
+    async def deliver(self, event):
+        pass
+
+
+class OutboxSink(Sink):
+    '''
+    The SIP path. The outbox takes care of retries from there
+    '''
+    name = 'sip'
+    retries = 0
+    durable = True
+
+    def __init__(self, outbox):
+        self._outbox = outbox
+
+    async def deliver(self, event):
+        await self._outbox.put(event.number, event.text)
+
+
+class TgSink(Sink):
+    name = 'tg'
+    queue_size = 16
+    # Each delivery waits for TG, so bursts need the workers to get coalesced
+    concurrency = 16
+    retries = 0
+
+    def __init__(self, tg_fwd):
+        self._tg_fwd = tg_fwd
+
+    async def deliver(self, event):
+        await self._tg_fwd.forward(event.number, event.text,
+                                   'Call' if event.kind == EVENT_MISSED_CALL else 'SMS')
+
+
+class WebhookSink(Sink):
+    '''
+    POSTs every event as JSON
+    '''
+    name = 'webhook'
+    queue_size = 256
+    concurrency = 4
+
+    def __init__(self, url):
+        self._url = url
+        # A session per executor thread, requests doesn't share them safely
+        self._local = threading.local()
+        self._executor = None
+
+    def _post(self, event):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        res = self._local.session.post(self._url, json=event._asdict(),
+                                       timeout=WEBHOOK_HTTP_TIMEOUT)
+        res.raise_for_status()
+
+    async def deliver(self, event):
+        # Sized once the pipeline has settled the sink's concurrency
+        if not self._executor:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._post, event)
+
+
+class JsonlSink(Sink):
+    '''
+    Appends every event as a line of JSON to a local file
+    '''
+    name = 'jsonl'
+    queue_size = 1024
+
+    def __init__(self, path):
+        self._path = path
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def _append(self, event):
+        with open(self._path, 'a') as f:
+            f.write(json.dumps(event._asdict()) + '\n')
+
+    async def deliver(self, event):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._append, event)
+
+
+class SmsCoalescer:
+    '''
+    Sits in front of an SMS forwarder, and turns the SMS that come in within
+    window seconds (per sender, or from everyone) into one digest. A send()
+    returns once the digest it went into is sent, and fails if that failed
+    '''
+    def __init__(self, sms_forwarder, window=COALESCE_WINDOW, max_msgs=COALESCE_MAX_MSGS,
+                 per_sender=True):
+        self._sms_forwarder = sms_forwarder
+        self._window = window
+        self._max_msgs = max_msgs
+        self._per_sender = per_sender
+        # sender (or None) -> [(number, text, future)]
+        self._pending = {}
+        # The loop only holds tasks weakly
+        self._tasks = set()
+
+    def forwarder(self, number, text):
+        coalescer = self
+
+        class Cls:
+            async def send(self):
+                await coalescer._add(number, text)
+        return Cls()
+
+    async def _add(self, number, text):
+        key = number if self._per_sender else None
+        fut = asyncio.get_running_loop().create_future()
+
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = []
+            self._spawn(self._flush_later(key, batch))
+        batch.append((number, text, fut))
+
+        if len(batch) >= self._max_msgs:
+            del self._pending[key]
+            self._spawn(self._send(batch))
+
+        await fut
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        '''
+        Cancels everything in flight. The SMS stay in the outbox, and go out
+        again on the next run
+        '''
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for batch in self._pending.values():
+            for _, _, fut in batch:
+                fut.cancel()
+        self._pending.clear()
+
+    async def _flush_later(self, key, batch):
+        await asyncio.sleep(self._window)
+        if self._pending.get(key) is batch:
+            del self._pending[key]
+            await self._send(batch)
+
+    async def _send(self, batch):
+        numbers = set(number for number, _, _ in batch)
+        if len(numbers) == 1:
+            number = numbers.pop()
+            text = '\n\n'.join(text for _, text, _ in batch)
+        else:
+            number = COALESCE_DIGEST_SENDER
+            text = '\n\n'.join('From %s: %s' % (n, text) for n, text, _ in batch)
+
+        if len(batch) > 1:
+            logger.info('Coalesced %d SMS from %s' % (len(batch), number))
+        try:
+            await self._sms_forwarder(number, text).send()
+        except Exception as e:
+            for _, _, fut in batch:
+                fut.set_exception(e)
+        else:
+            for _, _, fut in batch:
+                fut.set_result(True)
+        finally:
+            # Cancelled by close()
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.cancel()
+
+
+class ForwardingPipeline:
+    '''
+    Fans every event out to all the sinks. Each sink has its own bounded queue
+    and workers, so a slow sink only ever delays itself
+    '''
+    def __init__(self):
+        # [(sink, queue, concurrency, retries)]
+        self._sinks = []
+
+    def add_sink(self, sink, queue_size=None, concurrency=None, retries=None):
+        queue = asyncio.Queue(queue_size or sink.queue_size)
+        # The sink sees its actual worker count
+        sink.concurrency = concurrency or sink.concurrency
+        self._sinks.append((
+            sink, queue, sink.concurrency,
+            sink.retries if retries is None else retries,
+        ))
+        logger.info('Forwarding to %s' % (sink.name, ))
+
+    async def publish(self, kind, number, text):
+        event = Event(kind, number, text, time.time())
+        delivered = []
+
+        for sink, queue, _, _ in self._sinks:
+            if sink.durable:
+                fut = asyncio.get_running_loop().create_future()
+                delivered.append(fut)
+                await queue.put((event, fut))
+                continue
+
+            if queue.full():
+                logger.warning('%s: queue full, dropping the oldest event' % (sink.name, ))
+                queue.get_nowait()
+            queue.put_nowait((event, None))
+
+        await asyncio.gather(*delivered)
+
+    def forwarder(self, number, text, kind=EVENT_SMS):
+        pipeline = self
+
+        class Cls:
+            async def send(self):
+                await pipeline.publish(kind, number, text)
+        return Cls()
+
+    async def _deliver(self, sink, event, retries):
+        retry_delay = PIPELINE_RETRY_MIN
+        for attempt in range(retries + 1):
+            try:
+                await sink.deliver(event)
+                return
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                logger.warning('%s: delivery failed, retry in %ds: %r' % (
+                    sink.name, retry_delay, e
+                ))
+            await asyncio.sleep(retry_delay)
+            retry_delay *= 2
+
+    async def _sink_worker(self, sink, queue, retries):
+        while True:
+            event, fut = await queue.get()
+            try:
+                await self._deliver(sink, event, retries)
+            except Exception as e:
+                logger.error('%s: dropping %s event from %s: %r' % (
+                    sink.name, event.kind, event.number, e
+                ))
+                if fut and not fut.done():
+                    fut.set_exception(e)
+            else:
+                if fut and not fut.done():
+                    fut.set_result(True)
+
+    async def run(self):
+        await asyncio.gather(*[
+            self._sink_worker(sink, queue, retries)
+            for sink, queue, concurrency, retries in self._sinks
+            for _ in range(concurrency)
+        ])
@@ -0,0 +1,53 @@
+import os
+import json
+import time
+import logging
+
+
+PLMN_CACHE_MAX_ENTRIES = 4
+
+logger = logging.getLogger('PlmnCache')
+
+
+class PlmnCache:
+    '''
+    Last known good (operator, RAT) selections per IMSI, kept in a JSON file
+    '''
+    def __init__(self, path):
+        self._path = path
+        self._cache = self._load()
+
+    def _load(self):
+        try:
+            with open(self._path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.warning('Ignoring corrupt PLMN cache: %r' % (e, ))
+            return {}
+
+    def _save(self):
+        tmp_path = '%s.tmp' % (self._path, )
+        with open(tmp_path, 'w') as f:
+            json.dump(self._cache, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path)
+
+    def get(self, imsi):
+        '''
+        Returns [(numeric operator, AcT)], most recently successful first
+        '''
+        entries = sorted(self._cache.get(imsi, []), key=lambda e: e['ts'], reverse=True)
+        return [(e['operator'], e['act']) for e in entries]
+
+    def record(self, imsi, operator, act):
+        entries = [
+            e for e in self._cache.get(imsi, [])
+            if (e['operator'], e['act']) != (operator, act)
+        ]
+        entries.insert(0, {'operator': operator, 'act': act, 'ts': time.time()})
+        self._cache[imsi] = entries[:PLMN_CACHE_MAX_ENTRIES]
+        self._save()
+        logger.info('Remembered %s (type %d) for IMSI %s' % (operator, act, imsi))
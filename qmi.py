@@ -1,14 +1,70 @@
-import re
 import time
-import signal
+import random
+import struct
 import asyncio
 import logging
-import subprocess
 import contextlib
 
+import qmux
+from qmux import QmuxClient, QmiError
+
 
 NETWORK_QUICK_FAIL_TIMEOUT = 60
-CID_PATTERN = re.compile(rb'.*\sCID\:\s\'(\d+)\'.*', re.MULTILINE | re.DOTALL)
+NETWORK_RETRY_MIN = 1
+NETWORK_RETRY_MAX = 5 * 60
+WDS_START_TIMEOUT = 60
+WDS_STATUS_POLL_INTERVAL = 10
+WDS_STATS_INTERVAL = 60
+
+WDS_START_NETWORK = 0x0020
+WDS_STOP_NETWORK = 0x0021
+WDS_PACKET_SERVICE_STATUS = 0x0022
+WDS_GET_PACKET_STATISTICS = 0x0024
+WDS_SET_IP_FAMILY = 0x004d
+WDS_TLV_PACKET_DATA_HANDLE = 0x01
+WDS_TLV_CONNECTION_STATUS = 0x01
+WDS_TLV_IP_FAMILY = 0x19
+WDS_TLV_PREFERRED_IP_FAMILY = 0x01
+WDS_TLV_STATS_MASK = 0x01
+# Counter name -> (mask bit, response TLV, struct format)
+WDS_STATS = {
+    'tx_packets': (0x01, 0x10, '<I'),
+    'rx_packets': (0x02, 0x11, '<I'),
+    'tx_bytes': (0x40, 0x19, '<Q'),
+    'rx_bytes': (0x80, 0x1a, '<Q'),
+}
+IP_FAMILIES = {
+    'ipv4': 4,
+    'ipv6': 6,
+}
+WDS_CONNECTION_STATUS = {
+    1: 'disconnected',
+    2: 'connected',
+    3: 'suspended',
+    4: 'authenticating',
+}
+WDS_CONNECTED = 2
+
+VOICE_INDICATION_REGISTER = 0x0003
+VOICE_ALL_CALL_STATUS = 0x002e
+VOICE_TLV_CALL_NOTIFICATION_EVENTS = 0x13
+VOICE_TLV_CALL_INFO = 0x01
+VOICE_TLV_REMOTE_NUMBER = 0x10
+VOICE_CALL_INFO = struct.Struct('<BBBBBBB')
+VOICE_CALL_INCOMING = 0x02
+VOICE_CALL_CONVERSATION = 0x03
+VOICE_CALL_ALERTING = 0x05
+VOICE_CALL_DISCONNECTING = 0x08
+VOICE_CALL_END = 0x09
+VOICE_CALL_MO = 0x01
+VOICE_CALL_MT = 0x02
+# Voice, forced voice and VoLTE. Video, USSD/SUPS and the like aren't ours
+VOICE_CALL_TYPES = (0x00, 0x01, 0x02)
+# Call state -> progress of a call we dialed
+VOICE_MO_STATES = {
+    VOICE_CALL_ALERTING: 'alerting',
+    VOICE_CALL_CONVERSATION: 'active',
+}
 
 logger = logging.getLogger('QmiManager')
 
@@ -16,69 +72,230 @@ logger = logging.getLogger('QmiManager')
 class QmiVoiceException(Exception):
     pass
 
-class QmiNetworkException(Exception):
-    pass
-
 
 class QmiManager:
     '''
-    Wraps the qmicli utility by parsing its output
+    Talks QMI to the modem, through an in-process QMUX client
     '''
     def __init__(self, device, is_running_event):
         self._device = device
         self._is_running_event = is_running_event
+        self._qmux = None
+        self._voice_cid = None
+        # call id -> state, for the calls seen in VOICE indications
+        self._calls = {}
+        # ipv4/ipv6 -> counter name -> value
+        self.network_counters = {
+            family: dict({'connects': 0, 'disconnects': 0}, **{k: 0 for k in WDS_STATS})
+            for family in IP_FAMILIES
+        }
 
-    def _release_cid(self, cid):
-        subprocess.run(
-            ['qmicli', '-d', self._device, '--client-cid', str(cid), '--voice-noop']
-        )
+    def _get_qmux(self):
+        if self._qmux is None:
+            self._qmux = QmuxClient.open(self._device)
+        return self._qmux
 
-    @contextlib.contextmanager
-    def alloc_voice_cid(self):
-        # HACK: Allocate this CID first, so that set_current_host_app runs on openqti
-        subprocess.run(['qmicli', '-d', self._device, '--dms-noop'])
+    @contextlib.asynccontextmanager
+    async def alloc_voice_cid(self):
+        qmux_client = self._get_qmux()
 
-        proc = subprocess.run(
-            ['qmicli', '-d', self._device, '--client-no-release-cid', '--voice-noop'],
-            check=True, capture_output=True
-        )
+        # HACK: Allocate this CID first, so that set_current_host_app runs on openqti
+        dms_cid = await qmux_client.alloc_cid(qmux.QMI_SERVICE_DMS)
+        await qmux_client.release_cid(qmux.QMI_SERVICE_DMS, dms_cid)
 
-        match = re.match(CID_PATTERN, proc.stdout)
-        if not match:
-            raise QmiVoiceException(proc.stdout)
-        cid = int(match.groups()[0].decode())
+        try:
+            cid = await qmux_client.alloc_cid(qmux.QMI_SERVICE_VOICE)
+        except QmiError as e:
+            raise QmiVoiceException(e)
         logger.info('QMI allocated voice CID: %d' % (cid,))
+        self._voice_cid = cid
 
         try:
             yield
         finally:
-            self._release_cid(cid)
+            self._voice_cid = None
+            await qmux_client.release_cid(qmux.QMI_SERVICE_VOICE, cid)
             logger.info('QMI released voice CID: %d' % (cid,))
 
-    async def _follow_network_once(self):
-        proc = await asyncio.create_subprocess_shell(
-            'qmicli --device=%s --wds-start-network="ip-type=4"' % (self._device, ) +
-            ' --wds-follow-network | stdbuf -oL -eL uniq',
-            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+    def _parse_all_call_status(self, tlvs):
+        info = tlvs.get(VOICE_TLV_CALL_INFO, b'')
+        calls = [
+            VOICE_CALL_INFO.unpack_from(info, 1 + i * VOICE_CALL_INFO.size)
+            for i in range(info[0] if info else 0)
+        ]
+
+        numbers = {}
+        data = tlvs.get(VOICE_TLV_REMOTE_NUMBER, b'')
+        pos = 1
+        for i in range(data[0] if data else 0):
+            call_id, _, length = data[pos: pos + 3]
+            numbers[call_id] = data[pos + 3: pos + 3 + length].decode(errors='replace')
+            pos += 3 + length
+
+        return [(c[0], c[1], c[2], c[3], numbers.get(c[0], '')) for c in calls]
+
+    async def follow_calls(self, incoming_cb, ended_cb, mo_progress_cb=None):
+        '''
+        Calls incoming_cb(number) as soon as the modem reports an incoming
+        call, and ended_cb() once it's gone. mo_progress_cb(state) follows
+        the calls we dial. Needs the voice CID
+        '''
+        def on_all_call_status(client, tlvs):
+            if client not in (self._voice_cid, qmux.QMI_CID_BROADCAST):
+                return
+
+            calls = self._parse_all_call_status(tlvs)
+            for call_id, state, call_type, direction, number in calls:
+                if call_type not in VOICE_CALL_TYPES:
+                    logger.debug('Ignoring QMI call #%d of type %d' % (call_id, call_type))
+                    continue
+                prev_state = self._calls.get(call_id)
+                if state in (VOICE_CALL_DISCONNECTING, VOICE_CALL_END):
+                    if prev_state is not None:
+                        del self._calls[call_id]
+                        ended_cb()
+                    continue
+
+                self._calls[call_id] = state
+                if (direction == VOICE_CALL_MO and mo_progress_cb and
+                        state in VOICE_MO_STATES and prev_state != state):
+                    mo_progress_cb(VOICE_MO_STATES[state])
+
+                if (direction == VOICE_CALL_MT and state == VOICE_CALL_INCOMING and
+                        prev_state != VOICE_CALL_INCOMING):
+                    logger.info('QMI incoming call #%d from %s' % (call_id, number))
+                    incoming_cb(number)
+
+        try:
+            await self._qmux.request(
+                qmux.QMI_SERVICE_VOICE, self._voice_cid, VOICE_INDICATION_REGISTER,
+                {VOICE_TLV_CALL_NOTIFICATION_EVENTS: b'\x01'}
+            )
+        except QmiError as e:
+            # Some firmware sends call status indications without registering
+            logger.info('VOICE indication register: %r' % (e, ))
+
+        self._qmux.add_indication_handler(
+            qmux.QMI_SERVICE_VOICE, VOICE_ALL_CALL_STATUS, on_all_call_status
         )
 
-        while True:
-            line = await proc.stdout.readline()
-            if not line:
-                break
-            logger.info('qmicli: %s' % (line.decode().strip(), ))
+    async def _wds_status(self, cid):
+        res = await self._qmux.request(qmux.QMI_SERVICE_WDS, cid, WDS_PACKET_SERVICE_STATUS)
+        if not res.get(WDS_TLV_CONNECTION_STATUS):
+            raise QmiError('No connection status in %r' % (res, ))
+        return res[WDS_TLV_CONNECTION_STATUS][0]
+
+    async def _update_stats(self, cid, family):
+        mask = 0
+        for bit, _, _ in WDS_STATS.values():
+            mask |= bit
+        res = await self._qmux.request(qmux.QMI_SERVICE_WDS, cid, WDS_GET_PACKET_STATISTICS,
+                                       {WDS_TLV_STATS_MASK: struct.pack('<I', mask)})
+
+        counters = self.network_counters[family]
+        prev_bytes = counters['tx_bytes'], counters['rx_bytes']
+        for name, (_, tlv, fmt) in WDS_STATS.items():
+            if tlv in res:
+                counters[name], = struct.unpack(fmt, res[tlv])
+
+        logger.info('%s: tx %d pkts/%d bytes, rx %d pkts/%d bytes (%+d/%+d bytes)' % (
+            family, counters['tx_packets'], counters['tx_bytes'], counters['rx_packets'],
+            counters['rx_bytes'], counters['tx_bytes'] - prev_bytes[0],
+            counters['rx_bytes'] - prev_bytes[1],
+        ))
+
+    async def _follow_network_once(self, family):
+        qmux_client = self._get_qmux()
+        cid = await qmux_client.alloc_cid(qmux.QMI_SERVICE_WDS)
+        status_changed = asyncio.Event()
+
+        def on_status(client, tlvs):
+            if client == cid and WDS_TLV_CONNECTION_STATUS in tlvs:
+                status_changed.set()
+
+        qmux_client.add_indication_handler(
+            qmux.QMI_SERVICE_WDS, WDS_PACKET_SERVICE_STATUS, on_status
+        )
+        handle = None
+        try:
+            ip_family = bytes([IP_FAMILIES[family]])
+            try:
+                await qmux_client.request(qmux.QMI_SERVICE_WDS, cid, WDS_SET_IP_FAMILY,
+                                          {WDS_TLV_PREFERRED_IP_FAMILY: ip_family})
+            except QmiError as e:
+                logger.info('%s: WDS set IP family: %r' % (family, e))
+
+            res = await qmux_client.request(
+                qmux.QMI_SERVICE_WDS, cid, WDS_START_NETWORK,
+                {WDS_TLV_IP_FAMILY: ip_family}, timeout=WDS_START_TIMEOUT
+            )
+            if len(res.get(WDS_TLV_PACKET_DATA_HANDLE, b'')) != 4:
+                raise QmiError('No packet data handle in %r' % (res, ))
+            handle, = struct.unpack('<I', res[WDS_TLV_PACKET_DATA_HANDLE])
+            self.network_counters[family]['connects'] += 1
+            logger.info('%s: WDS network started, handle: 0x%08x' % (family, handle))
+
+            # Indications wake this up right away, polling covers missed ones
+            next_stats = time.monotonic()
+            while True:
+                status = await self._wds_status(cid)
+                if status != WDS_CONNECTED:
+                    logger.info('%s: WDS connection status: %s' % (
+                        family, WDS_CONNECTION_STATUS.get(status, status),
+                    ))
+                    break
+
+                if time.monotonic() >= next_stats:
+                    await self._update_stats(cid, family)
+                    next_stats = time.monotonic() + WDS_STATS_INTERVAL
+
+                status_changed.clear()
+                try:
+                    await asyncio.wait_for(status_changed.wait(),
+                                           timeout=WDS_STATUS_POLL_INTERVAL)
+                except asyncio.exceptions.TimeoutError:
+                    pass
 
-        await proc.wait()
+        except QmiError as e:
+            logger.warning('%s: WDS network error: %r' % (family, e))
 
-    async def _follow_network(self):
+        finally:
+            qmux_client.remove_indication_handler(
+                qmux.QMI_SERVICE_WDS, WDS_PACKET_SERVICE_STATUS, on_status
+            )
+            if handle is not None:
+                self.network_counters[family]['disconnects'] += 1
+                try:
+                    await qmux_client.request(
+                        qmux.QMI_SERVICE_WDS, cid, WDS_STOP_NETWORK,
+                        {WDS_TLV_PACKET_DATA_HANDLE: struct.pack('<I', handle)}
+                    )
+                except QmiError as e:
+                    logger.info('%s: WDS stop network: %r' % (family, e))
+            await qmux_client.release_cid(qmux.QMI_SERVICE_WDS, cid)
+
+    async def _supervise_network(self, family):
         await self._is_running_event.wait()
 
+        # A flaky data session only backs off, it never takes the voice side down
+        retry_delay = NETWORK_RETRY_MIN
         while True:
             start = time.monotonic()
-            await self._follow_network_once()
-            if time.monotonic() - start < NETWORK_QUICK_FAIL_TIMEOUT:
-                raise QmiNetworkException('Network disconnected too quickly')
+            try:
+                await self._follow_network_once(family)
+            except (QmiError, asyncio.exceptions.TimeoutError) as e:
+                logger.warning('%s: WDS session failed: %r' % (family, e))
+
+            if time.monotonic() - start >= NETWORK_QUICK_FAIL_TIMEOUT:
+                retry_delay = NETWORK_RETRY_MIN
+
+            delay = retry_delay + random.uniform(0, retry_delay)
+            logger.info('%s: Reconnecting in %.1fs' % (family, delay))
+            await asyncio.sleep(delay)
+            retry_delay = min(retry_delay * 2, NETWORK_RETRY_MAX)
 
-    def network_task(self):
-        return asyncio.create_task(self._follow_network())
+    async def _supervise_networks(self, families):
+        await asyncio.gather(*[self._supervise_network(family) for family in families])
 
+    def network_task(self, families=('ipv4', )):
+        return asyncio.create_task(self._supervise_networks(families))
@@ -0,0 +1,190 @@
+import os
+import struct
+import asyncio
+import logging
+import itertools
+
+
+QMUX_IF_TYPE = 0x01
+QMUX_MAX_FRAME = 0x4000
+QMUX_HEADER = struct.Struct('<BHBBB')
+CTL_HEADER = struct.Struct('<BBHH')
+SVC_HEADER = struct.Struct('<BHHH')
+TLV_HEADER = struct.Struct('<BH')
+RESULT_TLV = struct.Struct('<HH')
+
+QMI_SERVICE_CTL = 0x00
+QMI_SERVICE_WDS = 0x01
+QMI_SERVICE_DMS = 0x02
+QMI_SERVICE_NAS = 0x03
+QMI_SERVICE_VOICE = 0x09
+
+QMI_CTL_GET_CLIENT_ID = 0x0022
+QMI_CTL_RELEASE_CLIENT_ID = 0x0023
+
+CTL_FLAG_INDICATION = 0x02
+SVC_FLAG_INDICATION = 0x04
+QMI_CID_BROADCAST = 0xff
+
+TLV_RESULT = 0x02
+TLV_CLIENT_ID = 0x01
+QMI_TIMEOUT = 5
+
+logger = logging.getLogger('Qmux')
+
+
+class QmiError(Exception):
+    pass
+
+
+def encode_tlvs(tlvs):
+    return b''.join(TLV_HEADER.pack(t, len(v)) + v for t, v in tlvs.items())
+
+
+def decode_tlvs(data):
+    tlvs = {}
+    pos = 0
+    while pos + TLV_HEADER.size <= len(data):
+        t, length = TLV_HEADER.unpack_from(data, pos)
+        pos += TLV_HEADER.size
+        tlvs[t] = bytes(data[pos: pos + length])
+        pos += length
+    return tlvs
+
+
+class QmuxClient:
+    '''
+    Speaks QMUX directly on a cdc-wdm fd. Any stream fd (like one end of a
+    socketpair) replaying QMUX frames can stand in for the device
+    '''
+    def __init__(self, fd):
+        self._fd = fd
+        self._loop = asyncio.get_running_loop()
+        self._buf = bytearray()
+        self._ctl_txn = itertools.cycle(range(1, 0x100))
+        self._svc_txn = itertools.cycle(range(1, 0x10000))
+        # (service, client, txn) -> future
+        self._pending = {}
+        # (service, msg id) -> [callback(client, tlvs)]
+        self._indication_handlers = {}
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    @classmethod
+    def open(cls, device):
+        return cls(os.open(device, os.O_RDWR | os.O_NONBLOCK | os.O_NOCTTY))
+
+    def close(self):
+        self._loop.remove_reader(self._fd)
+        os.close(self._fd)
+        self._fail_pending(QmiError('QMUX device closed'))
+
+    def _fail_pending(self, e):
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.set_exception(e)
+        self._pending.clear()
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, QMUX_MAX_FRAME)
+        except BlockingIOError:
+            return
+        if not data:
+            self._loop.remove_reader(self._fd)
+            self._fail_pending(QmiError('QMUX device EOF'))
+            return
+
+        self._buf += data
+        while len(self._buf) >= QMUX_HEADER.size:
+            # The length excludes the leading I/F type byte
+            length, = struct.unpack_from('<H', self._buf, 1)
+            if len(self._buf) < length + 1:
+                break
+            frame = bytes(self._buf[:length + 1])
+            del self._buf[:length + 1]
+
+            try:
+                self._on_frame(frame)
+            except (struct.error, QmiError) as e:
+                logger.warning('Bad QMUX frame %s: %r' % (frame.hex(), e))
+
+    def _on_frame(self, frame):
+        if_type, _, _, service, client = QMUX_HEADER.unpack_from(frame)
+        if if_type != QMUX_IF_TYPE:
+            raise QmiError('Bad I/F type %d' % (if_type, ))
+
+        sdu = memoryview(frame)[QMUX_HEADER.size:]
+        if service == QMI_SERVICE_CTL:
+            flags, txn, msg_id, tlv_len = CTL_HEADER.unpack_from(sdu)
+            tlvs = decode_tlvs(sdu[CTL_HEADER.size: CTL_HEADER.size + tlv_len])
+            is_indication = flags & CTL_FLAG_INDICATION
+        else:
+            flags, txn, msg_id, tlv_len = SVC_HEADER.unpack_from(sdu)
+            tlvs = decode_tlvs(sdu[SVC_HEADER.size: SVC_HEADER.size + tlv_len])
+            is_indication = flags & SVC_FLAG_INDICATION
+
+        if is_indication:
+            for callback in self._indication_handlers.get((service, msg_id), []):
+                callback(client, tlvs)
+            return
+
+        fut = self._pending.pop((service, client, txn), None)
+        if fut and not fut.done():
+            fut.set_result(tlvs)
+
+    async def _write(self, frame):
+        while frame:
+            try:
+                written = os.write(self._fd, frame)
+            except BlockingIOError:
+                writable = self._loop.create_future()
+                self._loop.add_writer(self._fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self._loop.remove_writer(self._fd)
+                continue
+            frame = frame[written:]
+
+    async def request(self, service, client, msg_id, tlvs=None, timeout=QMI_TIMEOUT):
+        body = encode_tlvs(tlvs or {})
+        if service == QMI_SERVICE_CTL:
+            txn = next(self._ctl_txn)
+            sdu = CTL_HEADER.pack(0, txn, msg_id, len(body)) + body
+        else:
+            txn = next(self._svc_txn)
+            sdu = SVC_HEADER.pack(0, txn, msg_id, len(body)) + body
+        frame = QMUX_HEADER.pack(
+            QMUX_IF_TYPE, QMUX_HEADER.size - 1 + len(sdu), 0, service, client
+        ) + sdu
+
+        key = (service, client, txn)
+        fut = self._loop.create_future()
+        self._pending[key] = fut
+        try:
+            await self._write(frame)
+            res = await asyncio.wait_for(fut, timeout=timeout)
+        finally:
+            self._pending.pop(key, None)
+
+        if TLV_RESULT not in res:
+            raise QmiError('No result TLV for %02x/%04x' % (service, msg_id))
+        result, error = RESULT_TLV.unpack_from(res[TLV_RESULT])
+        if result != 0:
+            raise QmiError('QMI error %d for %02x/%04x' % (error, service, msg_id), error)
+        return res
+
+    async def alloc_cid(self, service):
+        res = await self.request(QMI_SERVICE_CTL, 0, QMI_CTL_GET_CLIENT_ID,
+                                 {TLV_CLIENT_ID: bytes([service])})
+        return res[TLV_CLIENT_ID][1]
+
+    async def release_cid(self, service, cid):
+        await self.request(QMI_SERVICE_CTL, 0, QMI_CTL_RELEASE_CLIENT_ID,
+                           {TLV_CLIENT_ID: bytes([service, cid])})
+
+    def add_indication_handler(self, service, msg_id, callback):
+        self._indication_handlers.setdefault((service, msg_id), []).append(callback)
+
+    def remove_indication_handler(self, service, msg_id, callback):
+        self._indication_handlers.get((service, msg_id), []).remove(callback)
@@ -5,21 +5,38 @@ import string
 import asyncio
 import logging
 import argparse
+import itertools
+import collections
 
 import serial_asyncio
 
+import sms
+
 
 MODEM_BAUD = 115200
-AT_SHORT_TIMEOUT = 0.2
 AT_MEDIUM_TIMEOUT = 0.5
 AT_LONG_TIMEOUT = 5
 MIN_ALLOWED_UNLOCK_ATTEMPTS = 3
-NETWORK_COPS_ATTEMPTS = 10
-COPS_SLEEP = 2
+NETWORK_REG_TIMEOUT = 20
 COPS_PASSIVE_SCAN_TIMEOUT = 4 * 60
 MANUAL_COPS_WAIT_SECONDS = 2 * 60
-MAX_MESSAGES = 30
-VOLTE_CHECK_ATTEMPTS = 20
+VOLTE_CHECK_TIMEOUT = 10
+IMS_POLL_INTERVAL = 2
+# PDP context ids 0-3 are ours, the rest are left alone
+PDP_MANAGED_CIDS = 4
+SMS_WORK_QUEUE_SIZE = 64
+CALL_WORK_QUEUE_SIZE = 8
+URC_LATENCY_WARN = 0.05
+# Deletions sent per AT command line
+SMS_DELETE_BATCH = 10
+SMS_OUT_QUEUE_SIZE = 256
+SMS_SEND_TIMEOUT = 60
+# AT+CMMS=1 holds the link for 1-5s after a submission, so re-arm it after a pause
+SMS_CMMS_HOLD = 1
+SMS_OUTGOING_KEEP = 256
+CALL_POLL_INTERVAL = 0.5
+# RING repeats every few seconds while a call is alerting
+RING_CYCLE_TIMEOUT = 10
 
 NET_TYPES = {
     0: 'GSM',
@@ -31,7 +48,61 @@ SCANMODE_FOR_NET_TYPE = {
     'UMTS': 2,
     'LTE': 3,
 }
-STATUS_REJECTED = 2
+# <AcT> of +CREG/+CGREG/+CEREG
+ACT_NET_TYPES = {
+    0: 'GSM',
+    3: 'GSM',
+    2: 'UMTS',
+    4: 'UMTS',
+    5: 'UMTS',
+    6: 'UMTS',
+    7: 'LTE',
+}
+REG_HOME = 1
+REG_DENIED = 3
+REG_ROAMING = 5
+REG_URC_PATTERN = re.compile(r'^\+(CREG|CGREG|CEREG)\:\ (\d+)(?:,([^,]*),([^,]*)(?:,(\d+))?)?')
+IMS_URC_PATTERN = re.compile(r'^\+QIND\:\ \"ims\",(\d+)')
+SENDER_WHITELIST_CHARS = string.ascii_letters + string.digits + '-_'
+
+AT_FINAL_CODES = (b'OK', b'ERROR')
+AT_FINAL_PREFIXES = (b'+CME ERROR:', b'+CMS ERROR:')
+AT_PROMPT = b'>'
+AT_CTRL_Z = b'\x1a'
+AT_ESC = b'\x1b'
+# Stands in for _last_cmd while the data after a prompt is being answered
+AT_DATA_FRAME = b'<data>'
+# Commands that may end with something other than OK/ERROR
+AT_CMD_FINAL_CODES = {
+    b'ATD': (b'CONNECT', b'NO CARRIER', b'BUSY', b'NO ANSWER', b'NO DIALTONE'),
+    b'ATA': (b'CONNECT', b'NO CARRIER'),
+    b'AT+CMGS': (AT_PROMPT, ),
+    b'AT+CMGW': (AT_PROMPT, ),
+}
+
+AT_PRIO_CALL = 0
+AT_PRIO_NORMAL = 1
+AT_PRIO_BULK = 2
+# Call control jumps ahead of everything, SMS storage sweeps go last
+AT_CMD_PRIORITY = {
+    b'ATA': AT_PRIO_CALL,
+    b'ATH': AT_PRIO_CALL,
+    b'ATD': AT_PRIO_CALL,
+    b'AT+CLCC': AT_PRIO_CALL,
+    # Must beat the network's RP-ACK timer
+    b'AT+CNMA': AT_PRIO_CALL,
+    b'AT+CMGR': AT_PRIO_BULK,
+    b'AT+CMGL': AT_PRIO_BULK,
+    b'AT+CMGD': AT_PRIO_BULK,
+}
+# <stat> of +CLCC -> progress of a call we dialed
+CLCC_MO_STATES = {
+    0: 'active',
+    2: 'dialing',
+    3: 'alerting',
+}
+# URCs whose payload follows on the next line
+AT_TWO_LINE_URCS = (b'+CMT:', b'+CDS:')
 
 logger = logging.getLogger('QuectelModem')
 
@@ -44,10 +115,145 @@ class NetworkError(Exception):
     pass
 
 
+class Urc(str):
+    '''
+    A URC line, stamped with the time it came off the TTY
+    '''
+    def __new__(cls, line, rx_time):
+        urc = super().__new__(cls, line)
+        urc.rx_time = rx_time
+        return urc
+
+
+class OutgoingSms:
+    '''
+    An SMS queued by send_sms(). state goes from queued to sent or failed, and
+    then to delivered or undelivered once the status reports are in
+    '''
+    _ids = itertools.count(1)
+
+    def __init__(self, number, text, status_report):
+        self.id = next(self._ids)
+        self.number = number
+        self.text = text
+        self.status_report = status_report
+        self.state = 'queued'
+        self.error = None
+        self.mrs = []
+        self._pending_mrs = set()
+        self._undelivered = False
+        self.sent = asyncio.get_running_loop().create_future()
+
+    def as_dict(self):
+        return {'id': self.id, 'number': self.number, 'state': self.state,
+                'mrs': self.mrs, 'error': self.error}
+
+    def _update_delivery(self):
+        if self.state != 'sent' or not self.status_report:
+            return
+        if self._undelivered:
+            self.state = 'undelivered'
+        elif not self._pending_mrs:
+            self.state = 'delivered'
+
+    def add_part(self, mr):
+        self.mrs.append(mr)
+        self._pending_mrs.add(mr)
+
+    def set_sent(self):
+        self.state = 'sent'
+        self._update_delivery()
+        if not self.sent.done():
+            self.sent.set_result(True)
+
+    def set_failed(self, error):
+        self.state = 'failed'
+        self.error = error
+        if not self.sent.done():
+            self.sent.set_exception(AtCommandError(error))
+
+    def got_report(self, mr, status):
+        # Reports can beat the submission of the later parts
+        if status >= sms.ST_PERMANENT:
+            self._undelivered = True
+            self.error = 'Status 0x%02x for part MR %d' % (status, mr)
+        self._pending_mrs.discard(mr)
+        self._update_delivery()
+
+
+class NetworkRegistration:
+    '''
+    Registration and IMS state, kept current by +CREG/+CGREG/+CEREG and +QIND URCs
+    '''
+    def __init__(self):
+        # CREG/CGREG/CEREG -> (stat, AcT)
+        self._domains = {}
+        self.ims = False
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def feed(self, line):
+        '''
+        Returns True if the line was a registration URC, and was consumed
+        '''
+        m = IMS_URC_PATTERN.match(line)
+        if m:
+            self.ims = m.groups()[0] == '1'
+            logger.info('IMS registered: %s' % (self.ims, ))
+            self._notify()
+            return True
+
+        m = REG_URC_PATTERN.match(line)
+        if not m:
+            return False
+
+        domain, stat, _, _, act = m.groups()
+        stat, act = int(stat), int(act) if act else None
+        if self._domains.get(domain) != (stat, act):
+            logger.info('%s: stat %d, type %s' % (domain, stat, ACT_NET_TYPES.get(act)))
+            self._domains[domain] = (stat, act)
+            self._notify()
+        return True
+
+    @property
+    def registered(self):
+        return any(stat in (REG_HOME, REG_ROAMING) for stat, _ in self._domains.values())
+
+    @property
+    def denied(self):
+        return not self.registered and any(
+            stat == REG_DENIED for stat, _ in self._domains.values()
+        )
+
+    @property
+    def net_type(self):
+        for domain in ('CEREG', 'CGREG', 'CREG'):
+            stat, act = self._domains.get(domain, (None, None))
+            if stat in (REG_HOME, REG_ROAMING) and act in ACT_NET_TYPES:
+                return ACT_NET_TYPES[act]
+        return None
+
+    async def wait_for(self, predicate, timeout):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=remaining)
+            except asyncio.exceptions.TimeoutError:
+                return False
+        return True
+
+
 class QuectelModemManager:
     def __init__(self, modem_tty, modem_baud=MODEM_BAUD, call_forwarder=None,
                  sms_forwarder=None, sim_card_pin=None, preferred_network='LTE',
-                 disregard_volte=False, extra_initer=None, apn=None):
+                 disregard_volte=False, extra_initer=None, apn=None, direct_sms=False,
+                 plmn_cache=None, warm_start=False):
         self._call_forwarder = call_forwarder
         self._sms_forwarder = sms_forwarder
         self._modem_tty = modem_tty
@@ -56,14 +262,39 @@ class QuectelModemManager:
         self._preferred_network = preferred_network
         self._disregard_volte = disregard_volte
         self._apn = apn
+        self._direct_sms = direct_sms
+        self._plmn_cache = plmn_cache
+        self._imsi = None
+        self._warm_start = warm_start
+        self._start_time = None
         self.sim_card_pin = sim_card_pin
 
         self._last_cmd = b''
-        self._response_q = asyncio.Queue()
+        self._response_fut = None
+        self._cmd_q = asyncio.PriorityQueue()
+        self._cmd_seq = itertools.count()
         self._urc_q = asyncio.Queue()
         self._in_call = False
+        self._clip_enabled = False
         self._call_fwd_task = None
+        # TTY times of the last RING of a live call, and of our last ATH0
+        self._ring_time = None
+        self._hangup_time = 0
         self._cur_csq = 0
+        self._mo_state = None
+        self._mo_progress_cb = None
+        self._net_reg = NetworkRegistration()
+        self._sms_parts = sms.ConcatCache()
+        self._sms_work_q = asyncio.Queue(SMS_WORK_QUEUE_SIZE)
+        self._call_work_q = asyncio.Queue(CALL_WORK_QUEUE_SIZE)
+        self._sms_resync = False
+        self._sms_out_q = asyncio.Queue(SMS_OUT_QUEUE_SIZE)
+        self._sms_ref = itertools.count()
+        # id -> OutgoingSms, oldest first
+        self._outgoing_sms = collections.OrderedDict()
+        # Message reference -> OutgoingSms, waiting for a status report
+        self._sms_by_mr = {}
+        self.urc_latency_max = 0
         self.is_running_event = asyncio.Event()
 
     async def _reset_at(self):
@@ -76,56 +307,132 @@ class QuectelModemManager:
             except asyncio.exceptions.TimeoutError:
                 break
 
+    def _final_codes(self, cmd):
+        for prefix, codes in AT_CMD_FINAL_CODES.items():
+            if cmd.startswith(prefix):
+                return AT_FINAL_CODES + codes
+        return AT_FINAL_CODES
+
+    def _is_final(self, cmd, line):
+        return line in self._final_codes(cmd) or line.startswith(AT_FINAL_PREFIXES)
+
+    async def _read_line(self, cmd):
+        if cmd is None or AT_PROMPT not in self._final_codes(cmd):
+            return (await self._modem_r.readline()).strip()
+
+        # The '> ' prompt isn't newline terminated, so read it bytewise
+        buf = b''
+        while not buf.endswith(b'\n') and buf.lstrip() != AT_PROMPT + b' ':
+            buf += await self._modem_r.readexactly(1)
+        return buf.strip()
+
     async def _tty_rx_handler(self):
-        async def getline(timeout=None):
-            rx = await asyncio.wait_for(self._modem_r.readline(), timeout=timeout)
-            return rx.strip()
+        cmd = None
+        lines = []
 
         while True:
-            line = await getline()
+            line = await self._read_line(cmd)
+
+            # Data sent after a prompt isn't always echoed, so its frame starts right away
+            if cmd is None and self._last_cmd == AT_DATA_FRAME:
+                cmd = AT_DATA_FRAME
+                lines = []
 
-            # If the line isn't the echo of _last_cmd, treat it as a URC
-            if not line.startswith(self._last_cmd) and line != b'':
-                await self._urc_q.put(line.decode())
+            # The echo of _last_cmd starts its response frame
+            if self._last_cmd and line.startswith(self._last_cmd):
+                cmd = self._last_cmd
+                lines = []
                 continue
 
-            elif line == b'':
+            # Outside of a response frame, every line is a URC
+            if cmd is None:
+                if line.startswith(AT_TWO_LINE_URCS):
+                    line += b'\n' + await self._read_line(None)
+                # Registration URCs wake their waiters right here, even mid-reset
+                if line != b'' and not self._net_reg.feed(line.decode()):
+                    await self._urc_q.put(Urc(line.decode(), time.monotonic()))
                 continue
 
-            # Treat the line as the start of the response to _last_cmd
-            lines = []
-            while True:
-                try:
-                    # Append lines until there is a short RX timeout, or OK/ERROR
-                    while True:
-                        lines.append(await getline(timeout=AT_SHORT_TIMEOUT))
-                        if lines[-1] in (b'OK', b'ERROR'):
-                            break
-                except asyncio.exceptions.TimeoutError:
-                    pass
-
-                # Try to send a new AT command to probe if last command finished
-                self._modem_w.write(b'AT\r')
-                line = await getline(timeout=AT_SHORT_TIMEOUT)
-
-                # If we got AT back, get the OK too and finish
-                if line == b'AT':
-                    line = await getline(timeout=AT_SHORT_TIMEOUT)
-                    if line == b'OK':
-                        break
-                    else:
-                        line.append(line)
-                else:
-                    # Otherwise, this line is part of the response. Continue
-                    lines.append(line)
+            lines.append(line)
+            if not self._is_final(cmd, line):
+                continue
+
+            # A frame of a command that already timed out is dropped
+            if cmd == self._last_cmd:
+                self._last_cmd = b''
+                if self._response_fut and not self._response_fut.done():
+                    self._response_fut.set_result((b'\n'.join(lines)).decode())
+            cmd = None
+
+    def _cmd_priority(self, cmd):
+        for prefix, priority in AT_CMD_PRIORITY.items():
+            if cmd.startswith(prefix):
+                return priority
+        return AT_PRIO_NORMAL
+
+    async def _transact(self, cmd, payload, timeout):
+        self._response_fut = asyncio.get_running_loop().create_future()
+        self._last_cmd = cmd
+        self._modem_w.write(payload)
+
+        try:
+            return await asyncio.wait_for(self._response_fut, timeout=max(timeout, 0))
+        except asyncio.exceptions.TimeoutError:
+            self._last_cmd = b''
+            raise
+        finally:
+            self._response_fut = None
+
+    async def _at_scheduler(self):
+        # Keeps exactly one command in flight, in priority order. A command
+        # with a prompt and its data go out back to back
+        while True:
+            _, _, cmd, data, deadline, fut = await self._cmd_q.get()
+            if fut.done():
+                continue
 
-            await self._response_q.put((b'\n'.join(lines)).decode())
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                fut.set_exception(asyncio.exceptions.TimeoutError())
+                continue
 
+            try:
+                result = await self._transact(cmd, b'%s\r' % (cmd,), remaining)
+                if result.endswith(AT_PROMPT.decode()):
+                    if data is None:
+                        self._modem_w.write(AT_ESC)
+                    else:
+                        result = await self._transact(AT_DATA_FRAME, data + AT_CTRL_Z,
+                                                      deadline - time.monotonic())
+            except asyncio.exceptions.TimeoutError as e:
+                if data is not None:
+                    # Don't leave the modem waiting for the rest of the data
+                    self._modem_w.write(AT_ESC)
+                if not fut.done():
+                    fut.set_exception(e)
+                continue
 
-    async def do_cmd(self, cmd, timeout=AT_LONG_TIMEOUT):
-        self._last_cmd = cmd.encode()
-        self._modem_w.write(b'%s\r' % (self._last_cmd,))
-        result = await asyncio.wait_for(self._response_q.get(), timeout=timeout)
+            if not fut.done():
+                fut.set_result(result)
+
+    def _queue_cmd(self, cmd, timeout=AT_LONG_TIMEOUT, priority=None, data=None):
+        '''
+        Queues cmd before returning, and returns the future of its result
+        '''
+        cmd = cmd.encode()
+        if priority is None:
+            priority = self._cmd_priority(cmd)
+
+        fut = asyncio.get_running_loop().create_future()
+        deadline = time.monotonic() + timeout
+        self._cmd_q.put_nowait((priority, next(self._cmd_seq), cmd, data, deadline, fut))
+        return fut
+
+    async def do_cmd(self, cmd, timeout=AT_LONG_TIMEOUT, priority=None, data=None):
+        '''
+        data is sent (with a Ctrl-Z) after the prompt of commands like AT+CMGS
+        '''
+        result = await self._queue_cmd(cmd, timeout, priority, data)
         logger.debug('%s -> %r' % (cmd, result))
         return result
 
@@ -161,44 +468,96 @@ class QuectelModemManager:
             logger.info('CSQ changed! %d -> %d (%d)' % (self._cur_csq, signal, unk))
             self._cur_csq = signal
 
+    async def _setup_reg_reporting(self):
+        for domain in ('CREG', 'CGREG', 'CEREG'):
+            self.verify_ok(await self.do_cmd('AT+%s=2' % (domain, )))
+
+            # Seed the state. The query has an extra leading <n> field
+            res = await self.do_cmd('AT+%s?' % (domain, ))
+            m = re.match(r'^\+%s\:\ \d+,(.*)$' % (domain, ), res, re.MULTILINE)
+            if m:
+                self._net_reg.feed('+%s: %s' % (domain, m.groups()[0]))
+
     async def _wait_for_network(self, disregard_pref=False):
-        connected = False
+        reg = self._net_reg
 
-        for i in range(NETWORK_COPS_ATTEMPTS):
-            await asyncio.sleep(COPS_SLEEP)
+        def settled():
+            return reg.denied or (reg.registered and (
+                disregard_pref or reg.net_type == self._preferred_network
+            ))
 
-            cops = await self.do_cmd('AT+COPS?')
-            m = re.match(r'^\+COPS\:\ (\d+),(\d+),(.*?),(\d+)', cops)
-            await self._measure_csq()
+        await reg.wait_for(settled, NETWORK_REG_TIMEOUT)
+        await self._measure_csq()
+        if not reg.registered:
+            logger.warning('Not registered%s' % (' (denied)' if reg.denied else '', ))
+            return False
+
+        net_type = reg.net_type
+        cops = await self.do_cmd('AT+COPS?')
+        m = re.match(r'^\+COPS\:\ (\d+),(\d+),(.*?),(\d+)', cops)
+        if m:
+            status, _, operator, act = m.groups()
+            net_type = NET_TYPES.get(int(act), net_type)
+            logger.info('Network: %s (%s), status: %s' % (operator, net_type, status))
+        else:
+            logger.warning('AT+COPS bad output: %r' % (cops, ))
 
-            if not m:
-                m = re.match(r'^\+COPS\:\ (\d+)', cops)
-                if not m:
-                    logger.warning('AT+COPS bad output: %r' % (cops, ))
-                    continue
+        return disregard_pref or net_type == self._preferred_network
 
-                status, = m.groups()
-                if int(status) == STATUS_REJECTED:
-                    logger.warning('AT+COPS got rejected status')
-                    break
-                continue
+    async def _read_imsi(self):
+        res = await self.do_cmd('AT+CIMI')
+        m = re.match(r'^(\d{6,15})$', res, re.MULTILINE)
+        if not m:
+            raise AtCommandError('Unexpected: %r' % (res, ))
+        return m.groups()[0]
 
-            status, _, operator, net_type = m.groups()
-            status, net_type = int(status), int(net_type)
-            logger.info('Network: %s (%s), status: %s' % (
-                operator, NET_TYPES[net_type], status)
-            )
+    async def _remember_network(self):
+        if not self._plmn_cache:
+            return
 
-            if disregard_pref or NET_TYPES[net_type] == self._preferred_network:
-                connected = True
-                break
+        # Read the operator in numeric format, then go back to long names
+        self.verify_ok(await self.do_cmd('AT+COPS=3,2'))
+        cops = await self.do_cmd('AT+COPS?')
+        self.verify_ok(await self.do_cmd('AT+COPS=3,0'))
+
+        m = re.match(r'^\+COPS\:\ \d+,2,\"(\d+)\",(\d+)', cops)
+        if not m:
+            logger.warning('AT+COPS bad output: %r' % (cops, ))
+            return
+        operator, net_type = m.groups()
+        self._plmn_cache.record(self._imsi, operator, int(net_type))
+
+    async def _try_cached_networks(self):
+        # The preferred RAT first, newest first within each. Anything that
+        # works beats the passive scan
+        cached = sorted(self._plmn_cache.get(self._imsi),
+                        key=lambda e: ACT_NET_TYPES.get(e[1]) != self._preferred_network)
+        for operator, act in cached:
+            preferred = ACT_NET_TYPES.get(act) == self._preferred_network
+            logger.info('Trying cached %s (%s)' % (operator, ACT_NET_TYPES.get(act)))
+
+            cops = await self.do_cmd('AT+COPS=1,2,"%s",%d' % (operator, act),
+                                     timeout=MANUAL_COPS_WAIT_SECONDS)
+            if 'ERROR' in cops:
+                continue
 
-        return connected
+            if await self._wait_for_network(disregard_pref=not preferred):
+                return True
+        return False
 
     async def _network_selection(self):
+        if self._plmn_cache and not self._imsi:
+            self._imsi = await self._read_imsi()
+
         logger.info('Waiting for network...')
         if await self._wait_for_network():
             logger.info('Auto-connected!')
+            await self._remember_network()
+            return
+
+        if self._plmn_cache and await self._try_cached_networks():
+            logger.info('Connected to a cached network!')
+            await self._remember_network()
             return
 
         self.verify_ok(await self.do_cmd('AT+COPS=2'))
@@ -251,6 +610,7 @@ class QuectelModemManager:
 
             if await self._wait_for_network(disregard_pref):
                 logger.info('Finally! Connected.')
+                await self._remember_network()
                 connected = True
                 break
 
@@ -276,7 +636,7 @@ class QuectelModemManager:
 
     async def _reset_apn(self):
         # Remove existing and add one apn-less PDP context
-        for i in range(4):
+        for i in range(PDP_MANAGED_CIDS):
             await self.do_cmd('AT+CGDCONT=%d' % i)
         self.verify_ok(await self.do_cmd('AT+CGDCONT=1,"IPV4V6"'))
 
@@ -288,28 +648,112 @@ class QuectelModemManager:
             self.verify_ok(await self.do_cmd('AT+CGDCONT=2,"IPV4V6","ims"'))
             self.verify_ok(await self.do_cmd('AT$QCPDPIMSCFGE=2,1'))
 
-    async def _reset(self):
-        retval = True
-        self.verify_ok(await self.do_cmd('AT'))
-        self.verify_ok(await self.do_cmd('AT+QURCCFG="urcport","all"'))
-        self.verify_ok(await self.do_cmd('ATH0'))
+    async def _setup_sms_routing(self):
+        # Status reports of sent SMS come as +CDS either way
+        if not self._direct_sms:
+            self.verify_ok(await self.do_cmd('AT+CNMI=2,1,0,1,0'))
+            return
 
-        if self._extra_initer:
-            retval = await self._extra_initer(self, self._urc_q).run()
+        # Phase 2+ makes the network wait for our +CNMA before it acks
+        self.verify_ok(await self.do_cmd('AT+CSMS=1'))
+        self.verify_ok(await self.do_cmd('AT+CNMI=2,2,0,1,0'))
+
+    def _desired_pdp_contexts(self):
+        contexts = {1: ('IPV4V6', (self._apn or '').lower())}
+        if not self._disregard_volte:
+            contexts[2] = ('IPV4V6', 'ims')
+        return contexts
+
+    def _desired_ims_config(self):
+        ims_config = {}
+        if self._apn:
+            ims_config[1] = 0
+        if not self._disregard_volte:
+            ims_config[2] = 1
+        return ims_config
+
+    async def _read_pdp_contexts(self):
+        res = await self.do_cmd('AT+CGDCONT?')
+        return {
+            int(cid): (pdp_type, apn.lower()) for cid, pdp_type, apn in
+            re.findall(r'^\+CGDCONT\:\ (\d+),\"(.*?)\",\"(.*?)\"', res, re.MULTILINE)
+            if int(cid) < PDP_MANAGED_CIDS
+        }
+
+    async def _ims_config_matches(self):
+        res = await self.do_cmd('AT$QCPDPIMSCFGE?')
+        ims_config = {
+            int(cid): int(flag) for cid, flag in
+            re.findall(r'^\$QCPDPIMSCFGE\:\ (\d+),(\d+)', res, re.MULTILINE)
+        }
+        return all(ims_config.get(cid) == flag
+                   for cid, flag in self._desired_ims_config().items())
+
+    async def _setup_sms(self):
+        self.verify_ok(await self.do_cmd('AT+CMGF=0'))
+        self.verify_ok(await self.do_cmd('AT+CPMS="ME","ME","ME"'))
+        await self._setup_sms_routing()
 
+    async def _cold_reset(self):
         scanmode = SCANMODE_FOR_NET_TYPE[self._preferred_network]
         self.verify_ok(await self.do_cmd('AT+QCFG="nwscanmode",%d' % (scanmode, )))
+        await self._setup_reg_reporting()
 
         await self._cfun_restart()
-        self.verify_ok(await self.do_cmd('AT+CMGF=1'))
-        self.verify_ok(await self.do_cmd('AT+CSDH=1'))
-        self.verify_ok(await self.do_cmd('AT+CPMS="ME","ME","ME"'))
+        await self._setup_sms()
 
         await self._reset_apn()
         await self._network_selection()
+
+    async def _warm_reset(self):
+        '''
+        Applies only what differs from the current modem state.
+        Returns False if the modem isn't up, and needs a cold reset
+        '''
+        cfun = await self.do_cmd('AT+CFUN?')
+        cpin = await self.do_cmd('AT+CPIN?')
+        if not re.match(r'^\+CFUN\:\ 1\b', cfun) or not re.match(r'^\+CPIN\:\ READY', cpin):
+            logger.info('Modem not up (%r, %r)' % (cfun, cpin))
+            return False
+
+        scanmode = SCANMODE_FOR_NET_TYPE[self._preferred_network]
+        res = await self.do_cmd('AT+QCFG="nwscanmode"')
+        m = re.match(r'^\+QCFG\:\ \"nwscanmode\",(\d+)', res)
+        if not m or int(m.groups()[0]) != scanmode:
+            logger.info('Updating nwscanmode to %d' % (scanmode, ))
+            self.verify_ok(await self.do_cmd('AT+QCFG="nwscanmode",%d,1' % (scanmode, )))
+
+        await self._setup_reg_reporting()
+        await self._setup_sms()
+
+        if await self._read_pdp_contexts() != self._desired_pdp_contexts() or \
+                not await self._ims_config_matches():
+            logger.info('Updating PDP contexts')
+            await self._reset_apn()
+
+        # Returns right away when already registered on the preferred network
+        await self._network_selection()
+        return True
+
+    async def _reset(self):
+        retval = True
+        self.verify_ok(await self.do_cmd('AT'))
+        self.verify_ok(await self.do_cmd('AT+QURCCFG="urcport","all"'))
+        self.verify_ok(await self.do_cmd('ATH0'))
+        # +CLIP carries the number right after RING, saving the AT+CLCC
+        self._clip_enabled = (await self.do_cmd('AT+CLIP=1')).endswith('OK')
+
+        if self._extra_initer:
+            retval = await self._extra_initer(self, self._urc_q).run()
+
+        if self._warm_start and not self._extra_initer and await self._warm_reset():
+            logger.info('Warm started')
+        else:
+            await self._cold_reset()
         return retval
 
     async def _handle_call(self):
+        # Only used when the modem has no +CLIP, and nothing else reported the call
         result = await self.do_cmd('AT+CLCC')
 
         for call in [c for c in result.split('\n') if c.startswith('+CLCC')]:
@@ -319,20 +763,29 @@ class QuectelModemManager:
             if mode == '0' and dir == '1' and state == '4':
                 break
         else:
-            logger.warning('Tried to handle a bad call: %r' % ((mode, dir, state, number),))
+            logger.warning('Tried to handle a bad call: %r' % (result,))
+            return
+
+        self.incoming_call(number.replace('"', ''))
+
+    def incoming_call(self, number):
+        '''
+        Starts forwarding an incoming GSM call. Whichever of QMI, +CLIP or
+        RING reports the call first wins
+        '''
+        if self._in_call or not self.is_running_event.is_set():
             return
 
         self._in_call = True
-        number = number.replace('"', '')
-        logger.info('[%s] Got call! #%s, number: %s, type: %s' % (
-            time.asctime(time.localtime()), idx, number, type)
-        )
+        logger.info('[%s] Got call! number: %s' % (time.asctime(time.localtime()), number))
 
         async def call_ended_cb():
-            self._in_call = False
             self._call_fwd_task = None
             logger.info('Call disconnected. Sending ATH0!')
-            self.verify_ok(await self.do_cmd('ATH0'))
+            try:
+                self.verify_ok(await self.do_cmd('ATH0'))
+            finally:
+                self._hung_up()
 
         async def call_connected_cb():
             logger.info('Call connected. Sending ATA!')
@@ -342,99 +795,328 @@ class QuectelModemManager:
             number, call_connected_cb, call_ended_cb
         ).run()
 
-    async def _handle_sms(self):
-        messages = []
-        segmented_messages = {}
-
-        for msg_index in range(MAX_MESSAGES):
-            msg = await self._parse_sms_single(msg_index, segmented_messages)
-            if msg:
-                messages.append(msg)
+    def remote_hangup(self):
+        if not self._in_call or not self._call_fwd_task:
+            return
 
-        logger.info('[%s] Got %d ready SMS, %d segmented' % (
-            time.asctime(time.localtime()), len(messages), len(segmented_messages)
-        ))
+        logger.info('Got GSM hangup. Cancelling call task!')
+        self._call_fwd_task.cancel()
 
-        for text, number, date, mtime, msg_indexes in messages:
-            text = '%s %s\n%s' % (date, mtime, text)
-            await self._sms_forwarder(number, text).send()
+    def dial(self, number, progress_cb):
+        '''
+        Dials number, with the ATD already queued when this returns.
+        progress_cb(state) gets 'dialing', 'alerting', 'active' and finally
+        'ended'. Returns the call task (cancel it to hang up), or None if busy
+        '''
+        if self._in_call or not self.is_running_event.is_set():
+            return None
 
-            for idx in msg_indexes:
-                self.verify_ok(await self.do_cmd('AT+CMGD=%d,0' % idx))
+        self._in_call = True
+        self._mo_state = None
+        self._mo_progress_cb = progress_cb
+        logger.info('[%s] Dialing %s' % (time.asctime(time.localtime()), number))
+
+        atd = self._queue_cmd('ATD%s;' % (number, ))
+        self._call_fwd_task = asyncio.create_task(self._follow_dial(atd))
+        return self._call_fwd_task
+
+    def call_progress(self, state):
+        '''
+        Progress of the call we dialed, from QMI indications or +CLCC
+        '''
+        if not self._mo_progress_cb or state == self._mo_state:
+            return
+        logger.info('Dialed call: %s' % (state, ))
+        self._mo_state = state
+        self._mo_progress_cb(state)
+
+    async def _follow_dial(self, atd):
+        try:
+            self.verify_ok(await atd)
+
+            # Polled until the call is up, in case nothing else reports progress
+            while self._mo_state != 'active':
+                res = await self.do_cmd('AT+CLCC')
+                # Voice calls we made
+                states = re.findall(r'^\+CLCC\:\ \d+,0,(\d+),0', res, re.MULTILINE)
+                if not states:
+                    logger.info('Dialed call is gone')
+                    return
+                if int(states[0]) in CLCC_MO_STATES:
+                    self.call_progress(CLCC_MO_STATES[int(states[0])])
+                await asyncio.sleep(CALL_POLL_INTERVAL)
+
+            # Up until either side hangs up, which cancels this task
+            await asyncio.Future()
+
+        except (AtCommandError, asyncio.exceptions.TimeoutError) as e:
+            logger.warning('Dial failed: %r' % (e, ))
+
+        finally:
+            self.call_progress('ended')
+            self._mo_progress_cb = None
+            self._call_fwd_task = None
+            logger.info('Dialed call ended. Sending ATH0!')
+            try:
+                await self.do_cmd('ATH0')
+            finally:
+                self._hung_up()
+
+    def _hung_up(self):
+        # URCs that came in until now are about the call that's gone
+        self._hangup_time = time.monotonic()
+        self._ring_time = None
+        self._in_call = False
 
-    def _xlate_sms_number(self, number):
-        # Is it an actual number?
-        if number.startswith('+') or number.startswith('0'):
-            return number
+    async def _sms_storage_usage(self):
+        res = await self.do_cmd('AT+CPMS?')
+        m = re.match(r'^\+CPMS\:\ \"\w+\",(\d+),(\d+)', res)
+        if not m:
+            raise AtCommandError('Unexpected: %r' % (res, ))
+        used, total = m.groups()
+        return int(used), int(total)
+
+    async def _read_stored_sms(self, msg_index):
+        res = await self.do_cmd('AT+CMGR=%d' % msg_index)
+        m = re.search(r'^\+CMGR\:\ .*\n([0-9A-Fa-f]+)$', res, re.MULTILINE)
+        # An empty slot gives no +CMGR line, or an error
+        if not m:
+            return []
+        return [(msg_index, bytes.fromhex(m.groups()[0]))]
+
+    async def _list_stored_sms(self):
+        used, total = await self._sms_storage_usage()
+        logger.info('SMS storage: %d/%d used' % (used, total))
+        if not used:
+            return []
+
+        res = await self.do_cmd('AT+CMGL=4')
+        self.verify_ok(res)
+        return [
+            (int(idx), bytes.fromhex(pdu)) for idx, pdu in
+            re.findall(r'^\+CMGL\:\ (\d+),.*\n([0-9A-Fa-f]+)$', res, re.MULTILINE)
+        ]
+
+    async def _handle_sms(self, msg_index=None):
+        messages = []
 
-        # Attempt to parse the garbled gsm-7 decimal garbage we get here
-        res = []
-        i = 0
-        while i < len(number):
-            if number[i] == '1':
-                char = int(number[i: i+3])
-                if char < 128:
-                    i += 3
-                    res.append(char)
-                    continue
-            char = int(number[i: i+2])
-            i += 2
-            res.append(char)
+        if msg_index is not None:
+            stored = await self._read_stored_sms(msg_index)
+            listed = None
+        else:
+            stored = await self._list_stored_sms()
+            listed = [idx for idx, _ in stored]
 
-        whitelist_chars = (string.ascii_letters + string.digits + '-_').encode()
-        filtered = bytes([c if c in whitelist_chars else ord('_') for c in res])
-        return filtered.decode()
+        for idx, pdu in stored:
+            msg = self._parse_sms_single(idx, pdu)
+            if msg:
+                messages.append(msg)
 
-    async def _parse_sms_single(self, msg_index, seg_dict):
-        result = await self.do_cmd('AT+QCMGR=%d' % msg_index)
-        self.verify_ok(result)
-        msg_lines = [s for s in result.split('\n') if s]
+        # Parts whose siblings never arrived are sent with the gaps marked
+        messages.extend(self._sms_parts.evict())
 
-        head_match = re.match(r'^\+QCMGR\:\ (.*?)$', msg_lines[0])
-        if not head_match:
-            return None
+        logger.info('[%s] Got %d ready SMS, %d segmented' % (
+            time.asctime(time.localtime()), len(messages), len(self._sms_parts)
+        ))
 
-        head = head_match.groups()[0].split(',')
-        head = [s.replace('"', '') for s in head]
+        await self._forward_sms(messages, listed)
 
-        segmented = False
-        _, number, _, date, mtime, _, _, _, _, _, _, size = head[:12]
+    async def _delete_stored_sms(self, indexes, listed=None):
+        if not indexes:
+            return
 
-        number = self._xlate_sms_number(number)
+        # Everything that was listed is done with. Delflag 1 deletes all read
+        # messages, and anything that came in since the listing is still unread
+        if listed is not None and sorted(indexes) == sorted(listed):
+            self.verify_ok(await self.do_cmd('AT+CMGD=1,1'))
+            return
 
-        # Could be a multi-part message. Has 3 extra fields in header
-        if len(head) == 15:
-            msg_uid, msg_seg, tot_seg = head[12:]
-            msg_seg, tot_seg = int(msg_seg), int(tot_seg)
-            segmented = True
-            # Make 0 based
-            msg_seg -= 1
+        for i in range(0, len(indexes), SMS_DELETE_BATCH):
+            self.verify_ok(await self.do_cmd('AT' + ';'.join(
+                '+CMGD=%d,0' % idx for idx in indexes[i: i + SMS_DELETE_BATCH]
+            )))
+
+    async def _forward_sms(self, messages, listed=None, stored=True):
+        '''
+        Forwards all the messages at once, then deletes the forwarded ones from
+        storage, unless they were never stored. listed is the storage listing
+        the messages came from, if any
+        '''
+        results = await asyncio.gather(*[
+            self._sms_forwarder(number, '%s %s\n%s' % (date, mtime, text)).send()
+            for text, number, date, mtime, _ in messages
+        ], return_exceptions=True)
+
+        indexes = []
+        errors = []
+        for (_, _, _, _, msg_indexes), res in zip(messages, results):
+            if isinstance(res, Exception):
+                errors.append(res)
+            else:
+                indexes.extend(msg_indexes)
+
+        if stored:
+            await self._delete_stored_sms(indexes, listed)
+        if errors:
+            raise errors[0]
+
+    async def _handle_sms_direct(self, urc):
+        _, _, pdu = urc.partition('\n')
+        try:
+            msg = sms.decode_deliver(bytes.fromhex(pdu))
+        except (ValueError, sms.PduError) as e:
+            # Acked anyway, the network would only send the same garbage again
+            logger.warning('Bad direct SMS: %r' % (e, ))
+            msg = None
+
+        logger.info('[%s] Got direct SMS' % (time.asctime(time.localtime()), ))
+        messages = []
+        number = msg and self._xlate_sms_number(msg.number)
+        if msg and msg.concat:
+            # Parts are acked once cached, or the network won't send the rest.
+            # So they stay cached until the whole message is forwarded
+            done = self._sms_parts.add(number, msg.date, msg.time, msg.text, msg.concat,
+                                       keep=True)
+            messages.extend([done] if done else [])
+        elif msg:
+            messages.append((msg.text, number, msg.date, msg.time, []))
+
+        try:
+            await self._forward_sms(messages, stored=False)
+        except Exception as e:
+            # Left unacked, the network delivers it again later
+            logger.warning('Direct SMS not forwarded: %r' % (e, ))
+        else:
+            if messages and msg.concat:
+                self._sms_parts.discard(number, msg.concat)
+            res = await self.do_cmd('AT+CNMA')
+            if res.endswith('OK'):
+                await self._forward_evicted_sms()
+                return
+            logger.warning('AT+CNMA failed: %r' % (res, ))
+
+        # A missed ack makes the modem turn +CMT routing off, so turn it back on
+        await self._setup_sms_routing()
+        await self._forward_evicted_sms()
+
+    async def _forward_evicted_sms(self):
+        # Parts from a storage listing still hold their slots
+        try:
+            await self._forward_sms(self._sms_parts.evict())
+        except Exception as e:
+            logger.warning('Incomplete SMS not forwarded: %r' % (e, ))
+
+    async def _handle_status_report(self, urc):
+        _, _, pdu = urc.partition('\n')
+        try:
+            report = sms.decode_status_report(bytes.fromhex(pdu))
+        except (ValueError, sms.PduError) as e:
+            logger.warning('Bad status report: %r' % (e, ))
+            report = None
+
+        if self._direct_sms:
+            res = await self.do_cmd('AT+CNMA')
+            if not res.endswith('OK'):
+                logger.warning('AT+CNMA failed: %r' % (res, ))
+                await self._setup_sms_routing()
+
+        # Reports with a temporary status mean the SC is still trying
+        if not report or sms.ST_TEMPORARY <= report.status < sms.ST_PERMANENT:
+            return
+        outgoing = self._sms_by_mr.pop(report.mr, None)
+        if outgoing:
+            outgoing.got_report(report.mr, report.status)
+            logger.info('SMS #%d to %s: %s' % (outgoing.id, outgoing.number, outgoing.state))
+
+    def send_sms(self, number, text, status_report=False):
+        '''
+        Queues an SMS for sending. Returns an OutgoingSms, whose sent future
+        is done once the SC took every part
+        '''
+        outgoing = OutgoingSms(number, text, status_report)
+        self._sms_out_q.put_nowait(outgoing)
+
+        self._outgoing_sms[outgoing.id] = outgoing
+        while len(self._outgoing_sms) > SMS_OUTGOING_KEEP:
+            self._outgoing_sms.popitem(last=False)
+        return outgoing
+
+    def get_sent_sms(self, sms_id):
+        return self._outgoing_sms.get(sms_id)
+
+    @property
+    def outgoing_sms_queued(self):
+        return self._sms_out_q.qsize()
+
+    @property
+    def in_call(self):
+        return self._in_call
+
+    async def _submit_sms(self, outgoing):
+        for pdu, tpdu_len in sms.encode_submit(outgoing.number, outgoing.text,
+                                               next(self._sms_ref), outgoing.status_report):
+            res = await self.do_cmd('AT+CMGS=%d' % (tpdu_len, ), timeout=SMS_SEND_TIMEOUT,
+                                    data=pdu.encode())
+            m = re.search(r'^\+CMGS\:\ (\d+)', res, re.MULTILINE)
+            if not m or not res.endswith('OK'):
+                raise AtCommandError(res)
+
+            mr = int(m.groups()[0])
+            outgoing.add_part(mr)
+            if outgoing.status_report:
+                self._sms_by_mr[mr] = outgoing
+
+    async def _sms_sender(self):
+        last_submit = 0
+        while True:
+            outgoing = await self._sms_out_q.get()
 
-        text = '\n'.join(msg_lines[1:])
-        if text.endswith('OK'):
-            text = text[:-2]
-        text = text.strip()
+            # Keeps the radio link up across the submissions of a burst
+            if time.monotonic() - last_submit > SMS_CMMS_HOLD:
+                res = await self.do_cmd('AT+CMMS=1')
+                if not res.endswith('OK'):
+                    logger.warning('AT+CMMS failed: %r' % (res, ))
 
-        # Could be hex-encoded UTF16
-        if size != len(text) and re.match(r'^[0-9A-F]+$', text) and len(text) % 2 == 0:
-            text = bytes.fromhex(text).decode('utf-16-be', errors='replace')
+            try:
+                await self._submit_sms(outgoing)
+            except (AtCommandError, asyncio.exceptions.TimeoutError) as e:
+                logger.warning('SMS #%d to %s failed: %r' % (outgoing.id, outgoing.number, e))
+                outgoing.set_failed(str(e))
+            else:
+                logger.info('SMS #%d to %s sent, MRs: %s' % (
+                    outgoing.id, outgoing.number, outgoing.mrs
+                ))
+                outgoing.set_sent()
+            last_submit = time.monotonic()
 
-        if not segmented:
-            return text, number, date, mtime, [msg_index]
+    def _xlate_sms_number(self, number):
+        # Is it an actual number?
+        if number.startswith('+') or number.isdigit():
+            return number
 
-        if msg_uid not in seg_dict:
-            seg_dict[msg_uid] = ([None] * tot_seg, [None] * tot_seg)
-        seg_dict[msg_uid][0][msg_seg] = text
-        seg_dict[msg_uid][1][msg_seg] = msg_index
+        # Alphanumeric senders end up in a SIP URI
+        return ''.join(c if c in SENDER_WHITELIST_CHARS else '_' for c in number)
 
-        # Segmented message not complete yet
-        if None in seg_dict[msg_uid][0]:
+    def _parse_sms_single(self, msg_index, pdu):
+        try:
+            msg = sms.decode_deliver(pdu)
+        except sms.PduError as e:
+            logger.warning('Bad SMS at %d: %r' % (msg_index, e))
             return None
 
-        return ''.join(seg_dict[msg_uid][0]), number, date, mtime, seg_dict[msg_uid][1]
+        number = self._xlate_sms_number(msg.number)
+        if not msg.concat:
+            return msg.text, number, msg.date, msg.time, [msg_index]
+
+        # Returns None while the segmented message isn't complete
+        return self._sms_parts.add(number, msg.date, msg.time, msg.text, msg.concat, msg_index)
 
     async def _check_volte(self):
-        for i in range(VOLTE_CHECK_ATTEMPTS):
+        # Older firmware has no IMS URC. Polling below still covers it
+        await self.do_cmd('AT+QINDCFG="ims",1')
+        deadline = time.monotonic() + VOLTE_CHECK_TIMEOUT
+
+        while True:
             res = await self.do_cmd('AT+QCFG="ims"')
             match = re.match(r'^\+QCFG\:\ \"ims\",(.*?),(.*?)$', res, re.MULTILINE)
             if not match:
@@ -442,33 +1124,93 @@ class QuectelModemManager:
 
             _, volte = match.groups()
             if volte == '1':
-                logger.info('IMS registered (VoLTE)')
                 break
-            await asyncio.sleep(AT_MEDIUM_TIMEOUT)
 
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise NetworkError('IMS not registered (no VoLTE): %r', res)
+            if await self._net_reg.wait_for(lambda: self._net_reg.ims,
+                                            min(IMS_POLL_INTERVAL, remaining)):
+                break
+
+        logger.info('IMS registered (VoLTE)')
+
+    def _urc_handled(self, urc):
+        latency = time.monotonic() - urc.rx_time
+        self.urc_latency_max = max(self.urc_latency_max, latency)
+        if latency > URC_LATENCY_WARN:
+            logger.warning('URC %r handled %.1fms after arrival' % (urc, latency * 1000))
         else:
-            raise NetworkError('IMS not registered (no VoLTE): %r', res)
+            logger.debug('URC %r handled %.1fms after arrival' % (urc, latency * 1000))
 
-    async def _urc_handler(self):
-        if self._preferred_network == 'LTE' and not self._disregard_volte:
-            await self._check_volte()
+    async def _call_worker(self):
+        while True:
+            urc = await self._call_work_q.get()
+            self._urc_handled(urc)
 
-        self.is_running_event.set()
+            if urc.rx_time < self._hangup_time:
+                logger.info('Ignoring %r from before the last hangup' % (urc, ))
+
+            elif urc.startswith('+CLIP:'):
+                # Only as part of a RING cycle that's still going
+                if self._ring_time is None or \
+                        urc.rx_time - self._ring_time > RING_CYCLE_TIMEOUT:
+                    logger.warning('Ignoring %r without a RING' % (urc, ))
+                    continue
+                m = re.match(r'^\+CLIP\:\ \"(.*?)\"', urc)
+                self.incoming_call(m.groups()[0] if m else '')
+
+            elif 'RING' == urc:
+                self._ring_time = urc.rx_time
+                if not self._in_call and not self._clip_enabled:
+                    await self._handle_call()
+
+            elif 'NO CARRIER' in urc:
+                self._ring_time = None
+                self.remote_hangup()
+
+    async def _sms_worker(self):
         await self._handle_sms()
 
+        while True:
+            urc = await self._sms_work_q.get()
+            self._urc_handled(urc)
+
+            if urc.startswith('+CMT:'):
+                await self._handle_sms_direct(urc)
+            elif urc.startswith('+CDS:'):
+                await self._handle_status_report(urc)
+            else:
+                m = re.match(r'^\+CMTI\:\ \"\w+\",(\d+)', urc)
+                await self._handle_sms(int(m.groups()[0]) if m else None)
+
+            # Dropped +CMTI/+CMT work is recovered by one storage listing
+            if self._sms_resync and self._sms_work_q.empty():
+                self._sms_resync = False
+                logger.warning('SMS work was dropped. Resyncing')
+                await self._setup_sms_routing()
+                await self._handle_sms()
+
+    def _dispatch(self, work_q, urc):
+        try:
+            work_q.put_nowait(urc)
+        except asyncio.QueueFull:
+            logger.warning('Work queue full, dropping URC: %r' % (urc,))
+            return False
+        return True
+
+    async def _urc_dispatcher(self):
+        # Never blocks on slow work, so call signalling isn't held up by SMS
         while True:
             urc = await self._urc_q.get()
             logger.info('URC -> %r' % (urc,))
 
-            if 'RING' == urc and not self._in_call:
-                await self._handle_call()
+            if 'RING' == urc or 'NO CARRIER' in urc or urc.startswith('+CLIP:'):
+                self._dispatch(self._call_work_q, urc)
 
-            if 'NO CARRIER' in urc and self._in_call:
-                logger.info('Got GSM hangup. Cancelling call task!')
-                self._call_fwd_task.cancel()
-
-            elif '+CMTI:' in urc:
-                await self._handle_sms()
+            elif urc.startswith(('+CMTI:', '+CMT:', '+CDS:')):
+                if not self._dispatch(self._sms_work_q, urc):
+                    self._sms_resync = True
 
             elif '+CPIN: NOT READY' in urc:
                 raise AtStateError(urc)
@@ -476,18 +1218,29 @@ class QuectelModemManager:
             else:
                 logger.warning('Uhandled URC: %r' % (urc,))
 
+    async def _urc_handler(self):
+        if self._preferred_network == 'LTE' and not self._disregard_volte:
+            await self._check_volte()
+
+        self.is_running_event.set()
+        logger.info('Modem ready %.1fs after startup' % (time.monotonic() - self._start_time, ))
+        await asyncio.gather(self._urc_dispatcher(), self._call_worker(), self._sms_worker(),
+                             self._sms_sender())
+
     async def run(self):
+        self._start_time = time.monotonic()
         self._modem_r, self._modem_w = await serial_asyncio.open_serial_connection(
             url=self._modem_tty, baudrate=self._modem_baud
         )
 
         await self._reset_at()
         rx_task = asyncio.create_task(self._tty_rx_handler())
+        at_task = asyncio.create_task(self._at_scheduler())
 
         logger.info('Got AT shell to modem. Resetting')
         if not await self._reset():
             return
 
         urc_task = asyncio.create_task(self._urc_handler())
-        await asyncio.gather(rx_task, urc_task)
+        await asyncio.gather(rx_task, at_task, urc_task)
 
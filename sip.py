@@ -2,23 +2,36 @@ import time
 import asyncio
 import logging
 import contextlib
+import collections
 
 from application.notification import NotificationCenter
 from sipsimple.account import Account
 from sipsimple.application import SIPApplication
-from sipsimple.storage import FileStorage
-from sipsimple.core import SIPURI, ToHeader, Message, FromHeader, RouteHeader
+from sipsimple.storage import MemoryStorage
+from sipsimple.core import SIPURI, ToHeader, Message, FromHeader, RouteHeader, Request, \
+    AudioMixer
 from sipsimple.lookup import DNSLookup, DNSLookupError
 from sipsimple.session import Session
 from sipsimple.streams.rtp.audio import AudioStream
 from sipsimple.threading.green import run_in_green_thread
 from sipsimple.configuration.datatypes import STUNServerAddress
+from sipsimple.configuration.settings import SIPSimpleSettings
 
 
 logger = logging.getLogger('SIP')
 
 STUN_SERVER = STUNServerAddress('stun.linphone.org')
 MSG_STATUS_ACCEPTED = 202
+# DNSLookup doesn't expose record TTLs, so routes are refreshed on a fixed interval
+ROUTE_REFRESH_INTERVAL = 5 * 60
+OPTIONS_PING_INTERVAL = 30
+OPTIONS_TIMEOUT = 10
+KEEPALIVE_URI = 'sip:keepalive@gsm'
+SIP_GROUP_TIMEOUT = 30
+SIP_MSG_WINDOW = 8
+SIP_ACCOUNT_POOL_SIZE = 32
+# sipsimple hands an INVITE to the enabled account with the Request-URI's user
+INBOUND_ACCOUNT = 'gsm@gsm'
 
 
 class TsFuture(asyncio.Future):
@@ -39,90 +52,383 @@ class TsFuture(asyncio.Future):
 
 class SIPMessageError(Exception):
     pass
+class SIPCallBusyError(Exception):
+    pass
+
+
+class SIPCall:
+    '''
+    The SIP side of one GSM call: the sessions it forked, and the one that
+    answered. audio_device is the ALSA card of the modem line it's on
+    '''
+    def __init__(self, callerid, audio_device=None):
+        self.callerid = callerid
+        self.audio_device = audio_device
+        self.sessions = set()
+        self.session = None
+        self.rang = False
 
 
 class SIPClient(SIPApplication):
-    def __init__(self, local_country_code, backup_fwd=None):
+    def __init__(self, local_country_code, backup_fwd=None, msg_window=SIP_MSG_WINDOW):
         SIPApplication.__init__(self)
         notification_center = NotificationCenter()
         notification_center.add_observer(self)
 
         self._did_app_start = TsFuture()
-        self._accounts = {}
-        self._session = None
+        # Caller identities, least recently used first
+        self._accounts = collections.OrderedDict()
+        # A call per audio device, or the calls would hear each other
+        self._busy_devices = set()
+        # ALSA card -> its own mixer, so lines with their own cards talk at once
+        self._mixers = {}
+        # Session -> (started, ended) futures, for every session still ringing or up
+        self._sessions = {}
+        # Session -> SIPCall, for the sessions of calls from GSM
+        self._session_calls = {}
+        # Message -> future, for every MESSAGE in flight
+        self._msgs = {}
+        self._msg_window = asyncio.Semaphore(msg_window)
+        # OPTIONS request -> callee URI, kept alive until the transaction ends
+        self._pings = {}
         self._local_country_code = local_country_code
         self._backup_fwd = backup_fwd
-        self.rang = False
-
-    def start(self, callee):
-        self._callee_uri = callee
-        super().start(FileStorage('sipconfig'))
+        self._sms_sender = None
+        self._dialer = None
+        # Incoming session -> time the GSM side answered
+        self._answer_times = {}
+        self._loop = asyncio.get_event_loop()
+        self._spare_stream = None
+        self._call_request_time = None
+
+    def start(self, callee_groups):
+        '''
+        callee_groups is a list of lists of URIs. The URIs of a group ring in
+        parallel, and the groups are tried one after the other
+        '''
+        self._callee_uri_groups = callee_groups
+        # Nothing is persisted, so new callers never cause disk writes
+        super().start(MemoryStorage())
 
     @run_in_green_thread
+    def _resolve_routes(self, fut):
+        routes = {}
+        for callee in self._callees:
+            try:
+                routes[str(callee.uri)] = DNSLookup().lookup_sip_proxy(
+                    callee.uri, ['udp', 'tls']
+                ).wait()
+            except DNSLookupError as e:
+                # Only the main destination is a must, MESSAGEs go there
+                if callee is self._callee:
+                    fut.set_exception(e)
+                    return
+                logger.warning('No routes for %s: %r' % (callee.uri, e))
+                routes[str(callee.uri)] = self._routes.get(str(callee.uri), [])
+
+        self._routes = routes
+        fut.set_result(True)
+
     def _NH_SIPApplicationDidStart(self, notification):
-        self._callee = ToHeader(SIPURI.parse(self._callee_uri))
-        try:
-            routes = DNSLookup().lookup_sip_proxy(
-                self._callee.uri, ['udp', 'tls']
-            ).wait()
-        except DNSLookupError as e:
-            self._did_app_start.set_exception(e)
-        else:
-            self._routes = routes
-            self._did_app_start.set_result(True)
+        self._callee_groups = [
+            [ToHeader(SIPURI.parse(uri)) for uri in group]
+            for group in self._callee_uri_groups
+        ]
+        self._callees = [callee for group in self._callee_groups for callee in group]
+        self._callee = self._callees[0]
+        self._routes = {}
+        self._resolve_routes(self._did_app_start)
+
+    def _NH_SIPInvitationChangedState(self, notification):
+        if notification.data.state == 'calling' and self._call_request_time:
+            logger.info('INVITE sent %.1fms after the call request' % (
+                (time.monotonic() - self._call_request_time) * 1000,
+            ))
+            self._call_request_time = None
+
+    def _NH_SIPRequestDidSucceed(self, notification):
+        self._pings.pop(notification.sender, None)
+
+    def _NH_SIPRequestDidFail(self, notification):
+        uri = self._pings.pop(notification.sender, None)
+        if uri is None:
+            return
+        logger.warning('OPTIONS ping to %s failed: %s %s' % (
+            uri, notification.data.code, notification.data.reason
+        ))
+
+    def _get_mixer(self, device):
+        # Lines without a card of their own share the default mixer
+        if device is None:
+            return None
+        if device not in self._mixers:
+            settings = SIPSimpleSettings()
+            self._mixers[device] = AudioMixer(
+                device, device, settings.audio.sample_rate,
+                settings.audio.echo_canceller.tail_length
+                if settings.audio.echo_canceller.enabled else 0
+            )
+            logger.info('Audio mixer for %s' % (device, ))
+        return self._mixers[device]
+
+    def _bind_audio_stream(self, stream, device):
+        # Streams only take their mixer once their session starts
+        mixer = self._get_mixer(device)
+        if mixer is not None:
+            stream.mixer = mixer
+        return stream
+
+    def _take_audio_stream(self, device=None):
+        stream = self._spare_stream or AudioStream()
+        self._spare_stream = None
+        # Pre-create the next one off the call path
+        asyncio.get_running_loop().call_soon(self._prepare_audio_stream)
+        return self._bind_audio_stream(stream, device)
+
+    def _prepare_audio_stream(self):
+        if self._spare_stream is None:
+            self._spare_stream = AudioStream()
+
+    def _send_options_ping(self):
+        for callee in self._callees:
+            routes = self._routes[str(callee.uri)]
+            if not routes:
+                continue
+            request = Request('OPTIONS', callee.uri, FromHeader(SIPURI.parse(KEEPALIVE_URI)),
+                              ToHeader(callee.uri), RouteHeader(routes[0].uri))
+            self._pings[request] = str(callee.uri)
+            request.send(timeout=OPTIONS_TIMEOUT)
+
+    async def _keepalive(self):
+        await self._did_app_start
+        self._prepare_audio_stream()
+        next_refresh = time.monotonic() + ROUTE_REFRESH_INTERVAL
+
+        while True:
+            # Keeps the transport (and TLS connection) warm for the next INVITE
+            self._send_options_ping()
+            await asyncio.sleep(OPTIONS_PING_INTERVAL)
+
+            if time.monotonic() < next_refresh:
+                continue
+            next_refresh = time.monotonic() + ROUTE_REFRESH_INTERVAL
+            fut = TsFuture()
+            self._resolve_routes(fut)
+            try:
+                await fut
+            except DNSLookupError as e:
+                logger.warning('Route refresh failed, keeping old routes: %r' % (e, ))
+
+    def keepalive_task(self):
+        return asyncio.create_task(self._keepalive())
+
+    async def wait_started(self):
+        await self._did_app_start
 
     def _NH_SIPSessionGotRingIndication(self, notification):
         logger.info('Ringing!')
-        self.rang = True
+        call = self._session_calls.get(notification.sender)
+        if call:
+            call.rang = True
+
+    async def accept_calls(self, dialer):
+        '''
+        Calls from the addresses of our destinations are dialed out through
+        dialer(number, progress_cb, busy_devices), with the number in the To
+        header. It returns (call task, audio device), or None if no line can
+        take the call
+        '''
+        await self._did_app_start
+        self._dialer = dialer
+        account = Account(INBOUND_ACCOUNT)
+        account.enabled = True
+        account.sip.register = False
+        account.rtp.encryption.enabled = True
+        account.save()
+
+    def _NH_SIPSessionNewIncoming(self, notification):
+        session = notification.sender
+        audio_streams = [s for s in notification.data.streams if s.type == 'audio']
+        peer = session.peer_address
+
+        if not self._dialer or not self._is_trusted_peer(peer.ip if peer else None):
+            logger.warning('Rejecting call from %s (%s)' % (session.remote_identity.uri, peer))
+            session.reject(403)
+            return
+        if not audio_streams:
+            session.reject(488)
+            return
+
+        number = str(session.local_identity.uri.user)
+        if not number.lstrip('+').isdigit():
+            session.reject(484)
+            return
+        self._loop.call_soon_threadsafe(
+            self._dial, session, number, audio_streams[0], time.monotonic()
+        )
+
+    def _dial(self, session, number, stream, invite_time):
+        def progress(state):
+            if state == 'alerting':
+                session.send_ring_indication()
+            elif state == 'active':
+                self._answer_times[session] = time.monotonic()
+                session.accept([stream])
+            elif state == 'ended' and session in self._sessions:
+                if session.state == 'incoming':
+                    session.reject(480)
+                else:
+                    session.end()
+
+        # The ATD is queued right here, in the turn the INVITE got to the loop
+        dialed = self._dialer(number, progress, self._busy_devices)
+        if dialed is None:
+            session.reject(486)
+            return
+        call_task, device = dialed
+        self._busy_devices.add(device)
+        self._bind_audio_stream(stream, device)
+        logger.info('Dialing %s, %.1fms after the INVITE' % (
+            number, (time.monotonic() - invite_time) * 1000
+        ))
+
+        ended = TsFuture()
+        self._sessions[session] = (TsFuture(), ended)
+        def call_ended(_):
+            self._busy_devices.discard(device)
+            # A SIP hangup hangs up the GSM side
+            call_task.cancel()
+        ended.add_done_callback(call_ended)
 
     def _NH_SIPSessionDidStart(self, notification):
-        logger.info('Call connected, session started!')
-        if not self._call_started.done():
-            self._call_started.set_result(True)
+        answer_time = self._answer_times.pop(notification.sender, None)
+        if answer_time:
+            logger.info('Audio up %.1fms after the GSM side answered' % (
+                (time.monotonic() - answer_time) * 1000,
+            ))
+        if notification.sender not in self._sessions:
+            return
+        logger.info('Call connected to %s, session started!' % (
+            notification.sender.remote_identity.uri,
+        ))
+        started, _ = self._sessions[notification.sender]
+        if not started.done():
+            started.set_result(True)
+
+    def _session_gone(self, session):
+        self._answer_times.pop(session, None)
+        self._session_calls.pop(session, None)
+        if session not in self._sessions:
+            return
+        started, ended = self._sessions.pop(session)
+        if not ended.done():
+            ended.set_result(True)
+        if not started.done():
+            started.cancel()
 
     def _NH_SIPSessionDidFail(self, notification):
-        logger.info('Call session connect failed')
-        if not self._call_ended.done():
-            self._call_ended.set_result(True)
-        if not self._call_started.done():
-            self._call_started.cancel()
+        logger.info('Call session connect failed: %s' % (notification.data.reason, ))
+        self._session_gone(notification.sender)
 
     def _NH_SIPSessionDidEnd(self, notification):
         logger.info('Call session ended')
-        if not self._call_ended.done():
-            self._call_ended.set_result(True)
-        if not self._call_started.done():
-            self._call_started.cancel()
+        self._session_gone(notification.sender)
+
+    def accept_messages(self, sms_sender):
+        '''
+        MESSAGEs to sip:<number>@... from the addresses of our destinations are
+        sent as SMS through sms_sender(number, text)
+        '''
+        self._sms_sender = sms_sender
+
+    def _NH_SIPEngineGotMessage(self, notification):
+        if not self._sms_sender:
+            return
+
+        data = notification.data
+        if not self._is_trusted_peer(data.source_ip):
+            logger.warning('Ignoring MESSAGE from %s (%s)' % (data.from_header.uri, data.source_ip))
+            return
+
+        number = str(data.request_uri.user)
+        text = data.body.decode(errors='replace') if isinstance(data.body, bytes) else data.body
+        if not number.lstrip('+').isdigit() or not text:
+            logger.warning('Ignoring MESSAGE to %s' % (data.request_uri, ))
+            return
+        self._loop.call_soon_threadsafe(self._send_sms, number, text)
+
+    def _is_trusted_peer(self, ip):
+        '''
+        The From header is whatever the sender says, so trust goes by the
+        transport peer being one of our destinations' routes
+        '''
+        if not ip:
+            logger.warning('No peer address to check, not trusting it')
+            return False
+        return any(str(ip) == route.address
+                   for routes in self._routes.values() for route in routes)
+
+    def _send_sms(self, number, text):
+        try:
+            outgoing = self._sms_sender(number, text)
+        except (asyncio.QueueFull, LookupError) as e:
+            logger.warning('Dropping MESSAGE to %s: %r' % (number, e))
+            return
+
+        def sent(fut):
+            if not fut.cancelled() and fut.exception():
+                logger.warning('MESSAGE to %s not sent as SMS: %r' % (number, fut.exception()))
+        outgoing.sent.add_done_callback(sent)
 
     def _NH_SIPMessageDidSucceed(self, notification):
+        msg_sent = self._msgs.pop(notification.sender, None)
+        if msg_sent is None:
+            return
         logger.info('Message was accepted by remote party')
-        self._msg_sent.set_result(True)
+        msg_sent.set_result(True)
 
     def _NH_SIPMessageDidFail(self, notification):
+        msg_sent = self._msgs.pop(notification.sender, None)
+        if msg_sent is None:
+            return
+
         if notification.data.code == MSG_STATUS_ACCEPTED:
             logger.info('Message is cached at the proxy. Hope for the best')
-            self._msg_sent.set_result(False)
+            msg_sent.set_result(False)
             return
 
         logger.info('Failed to deliver message: %d %s' % (
             notification.data.code, notification.data.reason)
         )
-        self._msg_sent.set_exception(
+        msg_sent.set_exception(
             SIPMessageError(notification.data.code, notification.data.reason)
         )
 
+    def _evict_accounts(self):
+        in_use = {session.account for session in self._sessions}
+        for account_str, account in list(self._accounts.items()):
+            if len(self._accounts) <= SIP_ACCOUNT_POOL_SIZE:
+                break
+            if account in in_use:
+                continue
+            del self._accounts[account_str]
+            account.delete()
+
     def _get_account(self, account_str):
-        if account_str not in self._accounts:
-            self._accounts[account_str] = Account(account_str)
-        return self._accounts[account_str]
+        account = self._accounts.pop(account_str, None) or Account(account_str)
+        self._accounts[account_str] = account
+        self._evict_accounts()
+        return account
 
     def _callerid_to_account(self, callerid):
+        # A caller ID may carry the line it came from, as number@line
+        callerid, _, line = callerid.partition('@')
         if not callerid:
             callerid = 'Unknown'
         if self._local_country_code and callerid.startswith(self._local_country_code):
             callerid = callerid.replace(self._local_country_code, '0')
 
-        account = self._get_account('%s@gsm' % callerid)
+        account = self._get_account('%s@%s' % (callerid, line or 'gsm'))
 
         account.display_name = callerid
         account.rtp.encryption.enabled = True
@@ -132,45 +438,94 @@ class SIPClient(SIPApplication):
 
         return account
 
-    async def call(self, callerid):
-        self.rang = False
-        await self._did_app_start
-        self._call_started = TsFuture()
-        self._call_ended = TsFuture()
+    async def _call_group(self, call, account, group, timeout):
+        sessions = {}
+        for callee in group:
+            routes = self._routes[str(callee.uri)]
+            if not routes:
+                continue
+            session = Session(account)
+            sessions[session] = self._sessions[session] = (TsFuture(), TsFuture())
+            call.sessions.add(session)
+            self._session_calls[session] = call
+            # Streams only open the audio device once their session starts,
+            # and only the session that answers ever does
+            session.connect(callee, routes, [self._take_audio_stream(call.audio_device)])
+
+        try:
+            deadline = time.monotonic() + timeout
+            pending = {started for started, _ in sessions.values()}
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(deadline - time.monotonic(), 0),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    break
+                for session, (started, _) in sessions.items():
+                    if started in done and not started.cancelled():
+                        call.session = session
+                        return True
+            return False
 
-        self._session = Session(self._callerid_to_account(callerid))
-        self._session.connect(self._callee, self._routes, [AudioStream()])
+        finally:
+            # First answer wins, the rest are cancelled right away
+            for session in sessions:
+                if session is not call.session and session in self._sessions:
+                    session.end()
+
+    async def call(self, call, group_timeout=SIP_GROUP_TIMEOUT):
+        '''
+        Rings the destinations for call (a SIPCall) until one answers
+        '''
+        if call.audio_device in self._busy_devices:
+            raise SIPCallBusyError('Audio device %s is in another call' % (call.audio_device, ))
+        self._busy_devices.add(call.audio_device)
+
+        self._call_request_time = time.monotonic()
+        await self._did_app_start
 
-        await self._call_started
+        account = self._callerid_to_account(call.callerid)
+        for group in self._callee_groups:
+            if await self._call_group(call, account, group, group_timeout):
+                return
+        # Nobody answered, so this rings out like a single unanswered call
+        await asyncio.Future()
 
-    async def end_call(self):
-        if self._session:
-            self._session.end()
-            await self.wait_call()
-            self._session = None
+    async def end_call(self, call):
+        for session in call.sessions:
+            if session in self._sessions:
+                session.end()
+        await self.wait_call(call)
+        self._busy_devices.discard(call.audio_device)
 
-    async def wait_call(self):
-        await self._call_ended
+    async def wait_call(self, call):
+        if call.session in self._sessions:
+            await self._sessions[call.session][1]
 
     async def message(self, callerid, msg_text):
         await self._did_app_start
-        self._msg_sent = TsFuture()
 
-        msg = Message(FromHeader(self._callerid_to_account(callerid).uri),
-                      self._callee, RouteHeader(self._routes[0].uri),
-                      'text/plain', msg_text)
-        msg.send()
+        async with self._msg_window:
+            msg = Message(FromHeader(self._callerid_to_account(callerid).uri),
+                          self._callee, RouteHeader(self._routes[str(self._callee.uri)][0].uri),
+                          'text/plain', msg_text)
+            msg_sent = self._msgs[msg] = TsFuture()
+            msg.send()
 
-        try:
-            result = await self._msg_sent
-        except Exception as e:
-            result = False
-            logger.warning('SIP message fwd error: %r' % (e, ))
+            try:
+                result = await msg_sent
+            except Exception as e:
+                result = False
+                logger.warning('SIP message fwd error: %r' % (e, ))
+            finally:
+                self._msgs.pop(msg, None)
 
         if not result and not self._backup_fwd:
             raise SIPMessageError('Fwd fail and no backup fwd given')
         elif not result:
-            self._backup_fwd.forward(callerid, msg_text)
+            # Only done once the backup has it too
+            await self._backup_fwd.forward(callerid, msg_text)
 
     @contextlib.contextmanager
     def context(self, callee):
@@ -182,46 +537,63 @@ class SIPClient(SIPApplication):
 
 
 class SIPCallForwarder:
-    def __init__(self, sip, callerid, connected_cb=None, ended_cb=None, call_timeout=90):
+    def __init__(self, sip, callerid, connected_cb=None, ended_cb=None, call_timeout=90,
+                 group_timeout=SIP_GROUP_TIMEOUT, missed_call_fwd=None, audio_device=None):
         self._sip = sip
+        self._call = SIPCall(callerid, audio_device)
+        self._missed_call_fwd = missed_call_fwd
         self._callerid = callerid
         self._connected_cb = connected_cb
         self._ended_cb = ended_cb
         self._call_timeout = call_timeout
+        self._group_timeout = group_timeout
 
     def run(self):
         return asyncio.create_task(self._call())
 
     async def _call(self):
         was_taken = False
+        was_busy = False
 
         try:
             try:
-                await asyncio.wait_for(self._sip.call(self._callerid),
-                                       timeout=self._call_timeout)
+                await asyncio.wait_for(
+                    self._sip.call(self._call, self._group_timeout),
+                    timeout=self._call_timeout
+                )
             except asyncio.exceptions.TimeoutError:
                 logger.info('Call timed out')
                 return
+            except SIPCallBusyError as e:
+                logger.info('Not forwarding call: %s' % (e, ))
+                was_busy = True
+                return
 
             was_taken = True
             if self._connected_cb:
                 await self._connected_cb()
-            await self._sip.wait_call()
+            await self._sip.wait_call(self._call)
 
         finally:
             if self._ended_cb:
                 await self._ended_cb()
 
-            await self._sip.end_call()
+            # The device is in another line's call
+            if not was_busy:
+                await self._sip.end_call(self._call)
             logger.info('Call ended')
 
             if was_taken:
                 return
             logger.info('Notifying of missed call')
-            await self._sip.message(self._callerid, 'Missed call at %s UTC %s' % (
+            msg = 'Missed call at %s UTC %s' % (
                 time.asctime(time.localtime()),
-                '(It rang)' if self._sip.rang else ''
-            ))
+                '(It rang)' if self._call.rang else ''
+            )
+            if self._missed_call_fwd:
+                await self._missed_call_fwd(self._callerid, msg).send()
+            else:
+                await self._sip.message(self._callerid, msg)
 
 
 class SIPSmsForwarder:
@@ -0,0 +1,359 @@
+import time
+import collections
+
+
+TOA_INTERNATIONAL = 0x10
+TOA_ALPHANUMERIC = 0x50
+TOA_TON_MASK = 0x70
+TOA_ISDN_INTERNATIONAL = 0x91
+TOA_ISDN_UNKNOWN = 0x81
+
+MTI_MASK = 0x03
+MTI_DELIVER = 0x00
+MTI_SUBMIT = 0x01
+MTI_STATUS_REPORT = 0x02
+FO_VPF_RELATIVE = 0x10
+FO_SRR = 0x20
+FO_UDHI = 0x40
+# 4 days, in the relative validity period format
+VP_RELATIVE = 0xaa
+DCS_GSM7 = 0x00
+DCS_UCS2 = 0x08
+
+# Status reports: below this the SM was delivered, from here the SC is still trying
+ST_TEMPORARY = 0x20
+ST_PERMANENT = 0x40
+
+ALPHABET_GSM7 = 0
+ALPHABET_8BIT = 1
+ALPHABET_UCS2 = 2
+
+IEI_CONCAT_8BIT_REF = 0x00
+IEI_CONCAT_16BIT_REF = 0x08
+
+CONCAT_TTL = 60 * 60
+CONCAT_MAX_ENTRIES = 64
+CONCAT_MISSING_PART = '[...]'
+# Single part limits, and the ones with room for an 8 bit ref concat header
+GSM7_MAX_SEPTETS = 160
+GSM7_CONCAT_SEPTETS = 153
+UCS2_MAX_UNITS = 70
+UCS2_CONCAT_UNITS = 67
+
+GSM7_ESCAPE = 0x1b
+GSM7_BASIC = (
+    '@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+    '¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà'
+)
+GSM7_EXTENSION = {
+    0x0a: '\f', 0x14: '^', 0x28: '{', 0x29: '}', 0x2f: '\\',
+    0x3c: '[', 0x3d: '~', 0x3e: ']', 0x40: '|', 0x65: '€',
+}
+
+# concat is (ref, total, seq) with a 1 based seq, or None
+DeliverPdu = collections.namedtuple(
+    'DeliverPdu', ('number', 'date', 'time', 'text', 'concat')
+)
+StatusReportPdu = collections.namedtuple('StatusReportPdu', ('mr', 'number', 'status'))
+
+GSM7_BASIC_CODES = {c: i for i, c in enumerate(GSM7_BASIC) if i != GSM7_ESCAPE}
+GSM7_EXTENSION_CODES = {c: i for i, c in GSM7_EXTENSION.items()}
+
+
+class PduError(Exception):
+    pass
+
+
+def _unpack_septets(data, count):
+    # Septets are packed LSB first, so the whole thing is one little endian int
+    bits = int.from_bytes(data, 'little')
+    return bytes((bits >> (7 * i)) & 0x7f for i in range(count))
+
+
+def _decode_gsm7(septets):
+    res = []
+    escaped = False
+    for c in septets:
+        if escaped:
+            res.append(GSM7_EXTENSION.get(c, ' '))
+            escaped = False
+        elif c == GSM7_ESCAPE:
+            escaped = True
+        else:
+            res.append(GSM7_BASIC[c])
+    return ''.join(res)
+
+
+def _decode_semi_octets(data):
+    digits = []
+    for b in data:
+        digits.append(b & 0x0f)
+        digits.append(b >> 4)
+    return ''.join('%d' % (d, ) for d in digits if d < 10)
+
+
+def _decode_address(pdu, pos):
+    num_digits, toa = pdu[pos], pdu[pos + 1]
+    end = pos + 2 + (num_digits + 1) // 2
+    data = pdu[pos + 2: end]
+
+    if toa & TOA_TON_MASK == TOA_ALPHANUMERIC:
+        return _decode_gsm7(_unpack_septets(data, num_digits * 4 // 7)), end
+
+    number = _decode_semi_octets(data)
+    if toa & TOA_TON_MASK == TOA_INTERNATIONAL:
+        number = '+' + number
+    return number, end
+
+
+def _decode_scts(data):
+    yy, mo, dd, hh, mi, ss = ((b & 0x0f) * 10 + (b >> 4) for b in data[:6])
+    # Quarters of an hour, with the sign in bit 3
+    tz = (data[6] & 0x07) * 10 + (data[6] >> 4)
+    sign = '-' if data[6] & 0x08 else '+'
+    return '%02d/%02d/%02d' % (yy, mo, dd), '%02d:%02d:%02d%s%02d' % (hh, mi, ss, sign, tz)
+
+
+def _alphabet(dcs):
+    group = dcs >> 4
+    if group < 0x8:
+        alphabet = (dcs >> 2) & 0x03
+        return alphabet if alphabet != 3 else ALPHABET_GSM7
+    if group == 0xe:
+        return ALPHABET_UCS2
+    if group == 0xf and dcs & 0x04:
+        return ALPHABET_8BIT
+    return ALPHABET_GSM7
+
+
+def _decode_udh(udh):
+    concat = None
+    pos = 0
+    while pos + 2 <= len(udh):
+        iei, iel = udh[pos], udh[pos + 1]
+        ie = udh[pos + 2: pos + 2 + iel]
+        pos += 2 + iel
+
+        if iei == IEI_CONCAT_8BIT_REF and iel == 3:
+            concat = (ie[0], ie[1], ie[2])
+        elif iei == IEI_CONCAT_16BIT_REF and iel == 4:
+            concat = ((ie[0] << 8) | ie[1], ie[2], ie[3])
+
+    # A total of 0 or 1 means the message isn't really concatenated
+    if concat and concat[1] < 2:
+        return None
+    return concat
+
+
+def decode_deliver(pdu):
+    '''
+    Decodes an SMS-DELIVER TPDU, prefixed by the SMSC address as the modem gives it
+    '''
+    pdu = memoryview(pdu)
+    try:
+        pos = 1 + pdu[0]
+        first_octet = pdu[pos]
+        if first_octet & MTI_MASK != MTI_DELIVER:
+            raise PduError('Not an SMS-DELIVER: %02x' % (first_octet, ))
+
+        number, pos = _decode_address(pdu, pos + 1)
+        dcs = pdu[pos + 1]
+        date, mtime = _decode_scts(pdu[pos + 2: pos + 9])
+        udl = pdu[pos + 9]
+        ud = pdu[pos + 10:]
+    except IndexError:
+        raise PduError('Truncated PDU: %s' % (pdu.hex(), ))
+
+    alphabet = _alphabet(dcs)
+    udh_len = 0
+    concat = None
+    if first_octet & FO_UDHI and ud:
+        udh_len = ud[0] + 1
+        concat = _decode_udh(ud[1: udh_len])
+
+    if alphabet == ALPHABET_GSM7:
+        # The header is padded to a septet boundary
+        udh_septets = (udh_len * 8 + 6) // 7
+        text = _decode_gsm7(_unpack_septets(ud, udl)[udh_septets:])
+    elif alphabet == ALPHABET_UCS2:
+        text = bytes(ud[udh_len: udl]).decode('utf-16-be', errors='replace')
+    else:
+        text = ud[udh_len: udl].hex()
+
+    return DeliverPdu(number, date, mtime, text, concat)
+
+
+def decode_status_report(pdu):
+    '''
+    Decodes an SMS-STATUS-REPORT TPDU, prefixed by the SMSC address
+    '''
+    pdu = memoryview(pdu)
+    try:
+        pos = 1 + pdu[0]
+        first_octet = pdu[pos]
+        if first_octet & MTI_MASK != MTI_STATUS_REPORT:
+            raise PduError('Not an SMS-STATUS-REPORT: %02x' % (first_octet, ))
+
+        mr = pdu[pos + 1]
+        number, pos = _decode_address(pdu, pos + 2)
+        # Skip the SC timestamp and the discharge time
+        status = pdu[pos + 14]
+    except IndexError:
+        raise PduError('Truncated PDU: %s' % (pdu.hex(), ))
+
+    return StatusReportPdu(mr, number, status)
+
+
+def _encode_gsm7(text):
+    '''
+    Returns the septets of text, or None if it doesn't fit the GSM 7 bit alphabet
+    '''
+    septets = []
+    for c in text:
+        if c in GSM7_BASIC_CODES:
+            septets.append([GSM7_BASIC_CODES[c]])
+        elif c in GSM7_EXTENSION_CODES:
+            septets.append([GSM7_ESCAPE, GSM7_EXTENSION_CODES[c]])
+        else:
+            return None
+    return septets
+
+
+def _pack_septets(udh, septets):
+    # The header is padded to a septet boundary, like decode_deliver() expects
+    pos = (len(udh) * 8 + 6) // 7 * 7
+    bits = int.from_bytes(udh, 'little')
+    for s in septets:
+        bits |= s << pos
+        pos += 7
+    return bits.to_bytes((pos + 7) // 8, 'little'), pos // 7
+
+
+def _encode_address(number):
+    toa = TOA_ISDN_INTERNATIONAL if number.startswith('+') else TOA_ISDN_UNKNOWN
+    digits = [int(d) for d in number if d.isdigit()]
+    padded = digits + [0xf] * (len(digits) % 2)
+    data = bytes(padded[i] | (padded[i + 1] << 4) for i in range(0, len(padded), 2))
+    return bytes([len(digits), toa]) + data
+
+
+def _split(units, limit, concat_limit):
+    '''
+    Splits a list of units (chars, each one a list of code units) into segments
+    '''
+    if sum(len(u) for u in units) <= limit:
+        return [[c for u in units for c in u]]
+
+    # A unit (an escaped char, a surrogate pair) never straddles two segments
+    segments = [[]]
+    for u in units:
+        if len(segments[-1]) + len(u) > concat_limit:
+            segments.append([])
+        segments[-1].extend(u)
+    return segments
+
+
+def encode_submit(number, text, ref=0, status_report=False):
+    '''
+    Encodes text as SMS-SUBMIT TPDUs, with concat headers when it takes more
+    than one. Returns [(hex PDU with an empty SMSC prefix, TPDU length)]
+    '''
+    septets = _encode_gsm7(text)
+    if septets is not None:
+        dcs = DCS_GSM7
+        segments = _split(septets, GSM7_MAX_SEPTETS, GSM7_CONCAT_SEPTETS)
+    else:
+        dcs = DCS_UCS2
+        units = [
+            [c.encode('utf-16-be')[i: i + 2] for i in range(0, len(c.encode('utf-16-be')), 2)]
+            for c in text
+        ]
+        segments = _split(units, UCS2_MAX_UNITS, UCS2_CONCAT_UNITS)
+
+    first_octet = MTI_SUBMIT | FO_VPF_RELATIVE
+    if status_report:
+        first_octet |= FO_SRR
+    if len(segments) > 1:
+        first_octet |= FO_UDHI
+
+    pdus = []
+    for seq, segment in enumerate(segments, 1):
+        udh = b''
+        if len(segments) > 1:
+            udh = bytes([5, IEI_CONCAT_8BIT_REF, 3, ref & 0xff, len(segments), seq])
+
+        if dcs == DCS_GSM7:
+            ud, udl = _pack_septets(udh, segment)
+        else:
+            ud = udh + b''.join(segment)
+            udl = len(ud)
+
+        # The modem fills in the message reference
+        tpdu = (bytes([first_octet, 0]) + _encode_address(number) +
+                bytes([0, dcs, VP_RELATIVE, udl]) + ud)
+        pdus.append(('00' + tpdu.hex().upper(), len(tpdu)))
+    return pdus
+
+
+class ConcatCache:
+    '''
+    Keeps the parts of concatenated SMS across events, until the last part lands
+    '''
+    def __init__(self, ttl=CONCAT_TTL, max_entries=CONCAT_MAX_ENTRIES):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        # (number, ref, total) -> [first seen, date, time, texts, tags]
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def tags(self):
+        return [t for entry in self._entries.values() for t in entry[4] if t is not None]
+
+    def add(self, number, date, mtime, text, concat, tag=None, keep=False):
+        '''
+        Returns (text, number, date, time, tags) once all parts are in, else None.
+        With keep, the complete message stays cached until discard()
+        '''
+        ref, total, seq = concat
+        key = (number, ref, total)
+        if key not in self._entries:
+            self._entries[key] = [time.monotonic(), date, mtime, [None] * total, [None] * total]
+        entry = self._entries[key]
+
+        if not 1 <= seq <= total:
+            return None
+        # The time of the first part is the time of the message
+        if seq == 1:
+            entry[1], entry[2] = date, mtime
+        entry[3][seq - 1] = text
+        entry[4][seq - 1] = tag
+
+        if None in entry[3]:
+            return None
+
+        if not keep:
+            del self._entries[key]
+        return ''.join(entry[3]), number, entry[1], entry[2], [t for t in entry[4] if t is not None]
+
+    def discard(self, number, concat):
+        ref, total, _ = concat
+        self._entries.pop((number, ref, total), None)
+
+    def evict(self):
+        '''
+        Drops expired entries, and the oldest ones beyond the size bound.
+        Returns them like add() does, with the missing parts marked
+        '''
+        evicted = []
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry[0] < self._ttl and len(self._entries) <= self._max_entries:
+                break
+
+            del self._entries[key]
+            text = ''.join(CONCAT_MISSING_PART if t is None else t for t in entry[3])
+            evicted.append((text, key[0], entry[1], entry[2], [t for t in entry[4] if t is not None]))
+        return evicted
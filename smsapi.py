@@ -0,0 +1,139 @@
+import json
+import asyncio
+import logging
+
+
+SMS_API_MAX_BODY = 64 * 1024
+SMS_API_TIMEOUT = 10
+HTTP_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    502: 'Bad Gateway',
+    503: 'Service Unavailable',
+}
+
+logger = logging.getLogger('SmsApi')
+
+
+class SmsApiError(Exception):
+    pass
+
+
+class SmsApi:
+    '''
+    A small JSON over HTTP API for sending SMS through the modem:
+        POST /sms {"number": ..., "text": ..., "report": false}
+            Answers once the SMS is sent, or failed
+        GET /sms/<id>
+            The SMS and its delivery state
+        GET /status
+            What status() returns, like the modems' network counters
+    listen is host:port, or the path of a unix socket
+    '''
+    def __init__(self, modem_manager, listen, status=None):
+        self._modem_manager = modem_manager
+        self._listen = listen
+        self._status = status
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode(errors='replace').split()
+        if len(request_line) != 3:
+            raise SmsApiError(400, 'Bad request line')
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode(errors='replace').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise SmsApiError(400, 'Bad Content-Length')
+        if length > SMS_API_MAX_BODY:
+            raise SmsApiError(400, 'Body too large')
+
+        body = await reader.readexactly(length) if length else b''
+        return request_line[0], request_line[1], body
+
+    async def _post_sms(self, body):
+        try:
+            req = json.loads(body)
+            number, text = str(req['number']), str(req['text'])
+        except (ValueError, KeyError, TypeError):
+            raise SmsApiError(400, 'Expected {"number": ..., "text": ...}')
+        if not number.lstrip('+').isdigit() or not text:
+            raise SmsApiError(400, 'Bad number or empty text')
+
+        try:
+            outgoing = self._modem_manager.send_sms(number, text, bool(req.get('report')))
+        except asyncio.QueueFull:
+            raise SmsApiError(503, 'Outgoing SMS queue is full')
+        except LookupError as e:
+            raise SmsApiError(503, str(e))
+
+        try:
+            # Shielded, the SMS goes out even if the client gives up on it
+            await asyncio.shield(outgoing.sent)
+        except Exception:
+            return 502, outgoing.as_dict()
+        return 200, outgoing.as_dict()
+
+    async def _route(self, method, path, body):
+        parts = path.strip('/').split('/')
+        if parts == ['status'] and self._status:
+            if method != 'GET':
+                raise SmsApiError(405, 'GET the status here')
+            return 200, self._status()
+
+        if parts[0] != 'sms' or len(parts) > 2:
+            raise SmsApiError(404, 'No such path')
+
+        if len(parts) == 1:
+            if method != 'POST':
+                raise SmsApiError(405, 'POST an SMS here')
+            return await self._post_sms(body)
+
+        if method != 'GET':
+            raise SmsApiError(405, 'GET the state of an SMS here')
+        outgoing = self._modem_manager.get_sent_sms(int(parts[1])) if parts[1].isdigit() else None
+        if not outgoing:
+            raise SmsApiError(404, 'No such SMS')
+        return 200, outgoing.as_dict()
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                method, path, body = await asyncio.wait_for(self._read_request(reader),
+                                                            timeout=SMS_API_TIMEOUT)
+                status, res = await self._route(method, path, body)
+            except SmsApiError as e:
+                status, res = e.args[0], {'error': e.args[1]}
+
+            data = json.dumps(res).encode()
+            writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n'
+                         b'Content-Length: %d\r\nConnection: close\r\n\r\n%s' % (
+                             status, HTTP_REASONS[status].encode(), len(data), data
+                         ))
+            await writer.drain()
+
+        except (asyncio.exceptions.TimeoutError, asyncio.IncompleteReadError,
+                ConnectionError) as e:
+            logger.info('SMS API client dropped: %r' % (e, ))
+        finally:
+            writer.close()
+
+    async def run(self):
+        if self._listen.startswith('/'):
+            server = await asyncio.start_unix_server(self._handle, path=self._listen)
+        else:
+            host, _, port = self._listen.rpartition(':')
+            server = await asyncio.start_server(self._handle, host or None, int(port))
+        logger.info('SMS API listening on %s' % (self._listen, ))
+
+        async with server:
+            await server.serve_forever()
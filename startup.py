@@ -0,0 +1,34 @@
+import time
+import asyncio
+import logging
+
+
+logger = logging.getLogger('Startup')
+
+
+class StartupOrchestrator:
+    '''
+    Runs the readiness phases of the gateway concurrently, timing each one
+    '''
+    def __init__(self):
+        self._phases = []
+        self.durations = {}
+
+    def add_phase(self, name, awaitable):
+        self._phases.append((name, awaitable))
+
+    async def _timed_phase(self, name, awaitable, start):
+        await awaitable
+        self.durations[name] = time.monotonic() - start
+        logger.info('Phase %s ready after %.2fs' % (name, self.durations[name]))
+
+    async def run(self):
+        start = time.monotonic()
+        await asyncio.gather(*[
+            self._timed_phase(name, awaitable, start) for name, awaitable in self._phases
+        ])
+
+        slowest = max(self.durations, key=self.durations.get)
+        logger.info('Gateway ready after %.2fs (slowest phase: %s)' % (
+            time.monotonic() - start, slowest
+        ))
@@ -0,0 +1,84 @@
+import gc
+import asyncio
+import unittest
+
+from pipeline import SmsCoalescer, COALESCE_DIGEST_SENDER
+
+
+class FakeSmsForwarder:
+    def __init__(self):
+        self.sent = []
+        self.error = None
+        self.block = None
+
+    def __call__(self, number, text):
+        forwarder = self
+
+        class Cls:
+            async def send(self):
+                if forwarder.block:
+                    await forwarder.block
+                if forwarder.error:
+                    raise forwarder.error
+                forwarder.sent.append((number, text))
+        return Cls()
+
+
+class SmsCoalescerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.fwd = FakeSmsForwarder()
+
+    async def test_per_sender(self):
+        coalescer = SmsCoalescer(self.fwd, window=0.05)
+        await asyncio.gather(*[
+            coalescer.forwarder(number, text).send()
+            for number, text in (('+1', 'a'), ('+2', 'b'), ('+1', 'c'))
+        ])
+        self.assertEqual(sorted(self.fwd.sent), [('+1', 'a\n\nc'), ('+2', 'b')])
+
+    async def test_global_digest(self):
+        coalescer = SmsCoalescer(self.fwd, window=0.05, per_sender=False)
+        await asyncio.gather(coalescer.forwarder('+1', 'a').send(),
+                             coalescer.forwarder('+2', 'b').send())
+        self.assertEqual(self.fwd.sent, [(COALESCE_DIGEST_SENDER, 'From +1: a\n\nFrom +2: b')])
+
+    async def test_max_msgs(self):
+        coalescer = SmsCoalescer(self.fwd, window=60, max_msgs=2)
+        await asyncio.wait_for(asyncio.gather(coalescer.forwarder('+1', 'a').send(),
+                                              coalescer.forwarder('+1', 'b').send()), 1)
+        self.assertEqual(self.fwd.sent, [('+1', 'a\n\nb')])
+
+    async def test_failure_reaches_every_sender(self):
+        self.fwd.error = RuntimeError('SIP down')
+        coalescer = SmsCoalescer(self.fwd, window=0.05)
+        results = await asyncio.gather(coalescer.forwarder('+1', 'a').send(),
+                                       coalescer.forwarder('+1', 'b').send(),
+                                       return_exceptions=True)
+        self.assertEqual([type(r) for r in results], [RuntimeError, RuntimeError])
+
+    async def test_flush_survives_gc(self):
+        coalescer = SmsCoalescer(self.fwd, window=0.05)
+        send = asyncio.create_task(coalescer.forwarder('+1', 'a').send())
+        await asyncio.sleep(0)
+        gc.collect()
+        await asyncio.wait_for(send, 1)
+        self.assertEqual(self.fwd.sent, [('+1', 'a')])
+
+    async def test_close(self):
+        self.fwd.block = asyncio.get_running_loop().create_future()
+        coalescer = SmsCoalescer(self.fwd, window=0.01, max_msgs=1)
+        sending = asyncio.create_task(coalescer.forwarder('+1', 'a').send())
+        coalescer_slow = SmsCoalescer(self.fwd, window=60)
+        pending = asyncio.create_task(coalescer_slow.forwarder('+2', 'b').send())
+        await asyncio.sleep(0.05)
+
+        await coalescer.close()
+        await coalescer_slow.close()
+        for task in (sending, pending):
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        self.assertEqual(self.fwd.sent, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
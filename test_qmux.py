@@ -0,0 +1,150 @@
+import socket
+import asyncio
+import unittest
+
+import qmux
+
+
+def response(service, client, txn, msg_id, tlvs, flags=None):
+    body = qmux.encode_tlvs(tlvs)
+    if service == qmux.QMI_SERVICE_CTL:
+        sdu = qmux.CTL_HEADER.pack(0x01 if flags is None else flags, txn, msg_id, len(body))
+    else:
+        sdu = qmux.SVC_HEADER.pack(0x02 if flags is None else flags, txn, msg_id, len(body))
+    sdu += body
+    return qmux.QMUX_HEADER.pack(qmux.QMUX_IF_TYPE, qmux.QMUX_HEADER.size - 1 + len(sdu),
+                                 0x80, service, client) + sdu
+
+
+def ok(tlvs=None):
+    tlvs = dict(tlvs or {})
+    tlvs[qmux.TLV_RESULT] = qmux.RESULT_TLV.pack(0, 0)
+    return tlvs
+
+
+class QmuxClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.modem, client_end = socket.socketpair()
+        self.modem.setblocking(False)
+        client_end.setblocking(False)
+        self.client = qmux.QmuxClient(client_end.detach())
+
+    async def asyncTearDown(self):
+        self.client.close()
+        self.modem.close()
+
+    async def read_request(self):
+        '''
+        Returns (service, client, txn, msg id, tlvs) of the next request
+        '''
+        loop = asyncio.get_running_loop()
+        header = await loop.sock_recv(self.modem, qmux.QMUX_HEADER.size)
+        _, length, _, service, client = qmux.QMUX_HEADER.unpack(header)
+        sdu = await loop.sock_recv(self.modem, length + 1 - qmux.QMUX_HEADER.size)
+        if service == qmux.QMI_SERVICE_CTL:
+            _, txn, msg_id, _ = qmux.CTL_HEADER.unpack_from(sdu)
+            tlvs = qmux.decode_tlvs(sdu[qmux.CTL_HEADER.size:])
+        else:
+            _, txn, msg_id, _ = qmux.SVC_HEADER.unpack_from(sdu)
+            tlvs = qmux.decode_tlvs(sdu[qmux.SVC_HEADER.size:])
+        return service, client, txn, msg_id, tlvs
+
+    async def test_alloc_release_cid(self):
+        alloc = asyncio.create_task(self.client.alloc_cid(qmux.QMI_SERVICE_VOICE))
+        service, client, txn, msg_id, tlvs = await self.read_request()
+        self.assertEqual((service, client, msg_id), (qmux.QMI_SERVICE_CTL, 0,
+                                                     qmux.QMI_CTL_GET_CLIENT_ID))
+        self.assertEqual(tlvs, {qmux.TLV_CLIENT_ID: bytes([qmux.QMI_SERVICE_VOICE])})
+        self.modem.send(response(service, 0, txn, msg_id, ok({
+            qmux.TLV_CLIENT_ID: bytes([qmux.QMI_SERVICE_VOICE, 7])
+        })))
+        self.assertEqual(await alloc, 7)
+
+        release = asyncio.create_task(self.client.release_cid(qmux.QMI_SERVICE_VOICE, 7))
+        service, _, txn, msg_id, tlvs = await self.read_request()
+        self.assertEqual(msg_id, qmux.QMI_CTL_RELEASE_CLIENT_ID)
+        self.assertEqual(tlvs, {qmux.TLV_CLIENT_ID: bytes([qmux.QMI_SERVICE_VOICE, 7])})
+        self.modem.send(response(service, 0, txn, msg_id, ok()))
+        await release
+
+    async def test_out_of_order_responses(self):
+        first = asyncio.create_task(self.client.request(qmux.QMI_SERVICE_NAS, 3, 0x24))
+        first_req = await self.read_request()
+        second = asyncio.create_task(self.client.request(qmux.QMI_SERVICE_NAS, 3, 0x24))
+        second_req = await self.read_request()
+        self.assertNotEqual(first_req[2], second_req[2])
+
+        # Answered the other way around, both frames in one read
+        self.modem.send(
+            response(*second_req[:4], ok({0x10: b'second'})) +
+            response(*first_req[:4], ok({0x10: b'first'}))
+        )
+        self.assertEqual((await first)[0x10], b'first')
+        self.assertEqual((await second)[0x10], b'second')
+
+    async def test_split_frame(self):
+        req = asyncio.create_task(self.client.request(qmux.QMI_SERVICE_DMS, 2, 0x25))
+        frame = response(*(await self.read_request())[:4], ok({0x01: b'1234'}))
+        self.modem.send(frame[:5])
+        await asyncio.sleep(0.01)
+        self.modem.send(frame[5:])
+        self.assertEqual((await req)[0x01], b'1234')
+
+    async def test_indications(self):
+        got = []
+        callback = lambda client, tlvs: got.append((client, tlvs))
+        self.client.add_indication_handler(qmux.QMI_SERVICE_VOICE, 0x2e, callback)
+
+        self.modem.send(response(qmux.QMI_SERVICE_VOICE, 7, 0, 0x2e, {0x01: b'\x01'},
+                                 flags=qmux.SVC_FLAG_INDICATION))
+        # Other messages, and responses nobody waits for, go nowhere
+        self.modem.send(response(qmux.QMI_SERVICE_VOICE, 7, 0, 0x2f, {},
+                                 flags=qmux.SVC_FLAG_INDICATION))
+        self.modem.send(response(qmux.QMI_SERVICE_VOICE, 7, 99, 0x2e, ok()))
+        await asyncio.sleep(0.05)
+        self.assertEqual(got, [(7, {0x01: b'\x01'})])
+
+        self.client.remove_indication_handler(qmux.QMI_SERVICE_VOICE, 0x2e, callback)
+        self.modem.send(response(qmux.QMI_SERVICE_VOICE, 7, 0, 0x2e, {},
+                                 flags=qmux.SVC_FLAG_INDICATION))
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(got), 1)
+
+    async def test_error_result(self):
+        req = asyncio.create_task(self.client.request(qmux.QMI_SERVICE_WDS, 1, 0x20))
+        self.modem.send(response(*(await self.read_request())[:4], {
+            qmux.TLV_RESULT: qmux.RESULT_TLV.pack(1, 0x0e)
+        }))
+        with self.assertRaises(qmux.QmiError) as cm:
+            await req
+        self.assertEqual(cm.exception.args[1], 0x0e)
+
+    async def test_no_result_tlv(self):
+        req = asyncio.create_task(self.client.request(qmux.QMI_SERVICE_WDS, 1, 0x20))
+        self.modem.send(response(*(await self.read_request())[:4], {}))
+        with self.assertRaises(qmux.QmiError):
+            await req
+
+    async def test_bad_frame_skipped(self):
+        req = asyncio.create_task(self.client.request(qmux.QMI_SERVICE_NAS, 3, 0x24))
+        service, client, txn, msg_id, _ = await self.read_request()
+        bad = bytearray(response(service, client, txn, msg_id, ok()))
+        bad[0] = 0x02
+        self.modem.send(bytes(bad) + response(service, client, txn, msg_id, ok()))
+        await req
+
+    async def test_eof_fails_pending(self):
+        req = asyncio.create_task(self.client.request(qmux.QMI_SERVICE_NAS, 3, 0x24))
+        await self.read_request()
+        self.modem.shutdown(socket.SHUT_WR)
+        with self.assertRaises(qmux.QmiError):
+            await req
+
+    async def test_timeout(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.client.request(qmux.QMI_SERVICE_NAS, 3, 0x24, timeout=0.05)
+        self.assertEqual(self.client._pending, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
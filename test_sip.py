@@ -0,0 +1,129 @@
+import types
+import asyncio
+import unittest
+
+try:
+    from sip import SIPClient, SIPCall, SIPCallBusyError, TsFuture
+except ImportError:
+    SIPClient = None
+
+
+def stub(**attrs):
+    return types.SimpleNamespace(**attrs)
+
+
+@unittest.skipIf(SIPClient is None, 'sipsimple is not installed')
+class PeerTrustTest(unittest.TestCase):
+    def setUp(self):
+        # Only the state the handlers touch, no SIP stack behind it
+        self.sip = SIPClient.__new__(SIPClient)
+        self.sip._routes = {'sip:me@pbx.example': [stub(address='192.0.2.10')]}
+        self.scheduled = []
+        self.sip._loop = stub(call_soon_threadsafe=lambda *args: self.scheduled.append(args))
+        self.sip._sms_sender = lambda number, text: None
+        self.sip._dialer = lambda number, progress_cb, busy_devices: None
+
+    def message(self, source_ip):
+        return stub(data=stub(
+            source_ip=source_ip, body=b'hi',
+            from_header=stub(uri='sip:me@pbx.example'),
+            request_uri=stub(user='+1234'),
+        ))
+
+    def invite(self, peer_ip):
+        self.rejected = []
+        session = stub(
+            peer_address=stub(ip=peer_ip) if peer_ip else None,
+            remote_identity=stub(uri='sip:me@pbx.example'),
+            local_identity=stub(uri=stub(user='+1234')),
+            reject=self.rejected.append,
+        )
+        return stub(sender=session, data=stub(streams=[stub(type='audio')]))
+
+    def test_message_from_route(self):
+        self.sip._NH_SIPEngineGotMessage(self.message('192.0.2.10'))
+        self.assertEqual([args[1:] for args in self.scheduled], [('+1234', 'hi')])
+
+    def test_message_spoofed_from(self):
+        with self.assertLogs('SIP', 'WARNING'):
+            self.sip._NH_SIPEngineGotMessage(self.message('198.51.100.7'))
+        self.assertEqual(self.scheduled, [])
+
+    def test_message_no_peer(self):
+        with self.assertLogs('SIP', 'WARNING') as logs:
+            self.sip._NH_SIPEngineGotMessage(self.message(None))
+        self.assertIn('No peer address', logs.output[0])
+        self.assertEqual(self.scheduled, [])
+
+    def test_invite_from_route(self):
+        self.sip._NH_SIPSessionNewIncoming(self.invite('192.0.2.10'))
+        self.assertEqual((self.rejected, len(self.scheduled)), ([], 1))
+
+    def test_invite_spoofed_from(self):
+        self.sip._NH_SIPSessionNewIncoming(self.invite('198.51.100.7'))
+        self.assertEqual((self.rejected, self.scheduled), ([403], []))
+
+    def test_invite_no_peer(self):
+        with self.assertLogs('SIP', 'WARNING') as logs:
+            self.sip._NH_SIPSessionNewIncoming(self.invite(None))
+        self.assertIn('No peer address', logs.output[0])
+        self.assertEqual(self.rejected, [403])
+
+    def test_missing_attribute_is_loud(self):
+        notification = self.message('192.0.2.10')
+        del notification.data.source_ip
+        with self.assertRaises(AttributeError):
+            self.sip._NH_SIPEngineGotMessage(notification)
+
+
+class FakeSession:
+    def __init__(self, sip, ended):
+        self._sip = sip
+        self._ended = ended
+
+    def end(self):
+        self._ended.append(self)
+        self._sip._session_gone(self)
+
+
+@unittest.skipIf(SIPClient is None, 'sipsimple is not installed')
+class PerCallStateTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.sip = SIPClient.__new__(SIPClient)
+        self.sip._sessions = {}
+        self.sip._session_calls = {}
+        self.sip._answer_times = {}
+        self.sip._busy_devices = set()
+        self.ended = []
+
+    def answered_call(self, device):
+        call = SIPCall('+1234', device)
+        session = FakeSession(self.sip, self.ended)
+        self.sip._sessions[session] = (TsFuture(), TsFuture())
+        self.sip._session_calls[session] = call
+        self.sip._busy_devices.add(device)
+        call.sessions.add(session)
+        call.session = session
+        return call
+
+    async def test_end_call_ends_own_sessions(self):
+        first, second = self.answered_call('hw:1'), self.answered_call('hw:2')
+        await asyncio.wait_for(self.sip.end_call(first), 1)
+
+        self.assertEqual(self.ended, [first.session])
+        self.assertIn(second.session, self.sip._sessions)
+        self.assertEqual(self.sip._busy_devices, {'hw:2'})
+
+    async def test_busy_per_device(self):
+        self.answered_call('hw:1')
+        with self.assertRaises(SIPCallBusyError):
+            await self.sip.call(SIPCall('+1234', 'hw:1'))
+
+    def test_ring_marks_its_call(self):
+        first, second = self.answered_call('hw:1'), self.answered_call('hw:2')
+        self.sip._NH_SIPSessionGotRingIndication(stub(sender=second.session))
+        self.assertEqual((first.rang, second.rang), (False, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
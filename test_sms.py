@@ -0,0 +1,172 @@
+import unittest
+
+import sms
+
+
+def as_deliver(submit_pdu):
+    '''
+    Turns an encode_submit() PDU into the SMS-DELIVER the recipient gets
+    '''
+    tpdu = bytes.fromhex(submit_pdu)[1:]
+    addr_end = 4 + (tpdu[2] + 1) // 2
+    first_octet = sms.MTI_DELIVER | (tpdu[0] & sms.FO_UDHI)
+    scts = bytes.fromhex('42107021430580')
+    return (bytes([0, first_octet]) + tpdu[2: addr_end] + tpdu[addr_end: addr_end + 2] +
+            scts + tpdu[addr_end + 3:])
+
+
+class DecodeTest(unittest.TestCase):
+    def test_deliver_gsm7(self):
+        pdu = bytes.fromhex(
+            '07911326040000F0040B911346610089F60000208062917314080CC8F71D14969741F977FD07'
+        )
+        self.assertEqual(sms.decode_deliver(pdu), sms.DeliverPdu(
+            '+31641600986', '02/08/26', '19:37:41-00', 'How are you?', None
+        ))
+
+    def test_deliver_ucs2_concat(self):
+        ud = bytes([5, sms.IEI_CONCAT_8BIT_REF, 3, 0x42, 2, 1]) + 'שלום'.encode('utf-16-be')
+        pdu = (bytes([0, sms.FO_UDHI, 4, sms.TOA_ISDN_INTERNATIONAL, 0x21, 0x43, 0, sms.DCS_UCS2])
+               + bytes.fromhex('42107021430580') + bytes([len(ud)]) + ud)
+        msg = sms.decode_deliver(pdu)
+        self.assertEqual((msg.number, msg.date, msg.time), ('+1234', '24/01/07', '12:34:50+08'))
+        self.assertEqual((msg.text, msg.concat), ('שלום', (0x42, 2, 1)))
+
+    def test_deliver_alphanumeric_sender(self):
+        # 'Bank' packed, 8 semi-octets
+        pdu = bytes.fromhex('0000' + '08D0C2B07B0D' + '0000' + '42107021430580' + '02C834')
+        msg = sms.decode_deliver(pdu)
+        self.assertEqual((msg.number, msg.text), ('Bank', 'Hi'))
+
+    def test_not_a_deliver(self):
+        with self.assertRaises(sms.PduError):
+            sms.decode_deliver(bytes.fromhex(sms.encode_submit('+1234', 'hi')[0][0]))
+
+    def test_truncated(self):
+        with self.assertRaises(sms.PduError):
+            sms.decode_deliver(bytes.fromhex('0004049121'))
+
+    def test_status_report(self):
+        pdu = bytes.fromhex('0006' + '2A' + '04912143' + '42107021430580' * 2 + '00')
+        self.assertEqual(sms.decode_status_report(pdu), sms.StatusReportPdu(0x2a, '+1234', 0))
+
+    def test_status_report_truncated(self):
+        with self.assertRaises(sms.PduError):
+            sms.decode_status_report(bytes.fromhex('00062A04912143'))
+
+
+class EncodeTest(unittest.TestCase):
+    def test_single_gsm7(self):
+        self.assertEqual(sms.encode_submit('+123', 'hello'),
+                         [('001100039121F30000AA05E8329BFD06', 15)])
+
+    def test_status_report_request(self):
+        pdu, _ = sms.encode_submit('+123', 'hello', status_report=True)[0]
+        self.assertTrue(bytes.fromhex(pdu)[1] & sms.FO_SRR)
+
+    def test_national_number(self):
+        pdu, _ = sms.encode_submit('0501234567', 'hi')[0]
+        self.assertEqual(sms.decode_deliver(as_deliver(pdu)).number, '0501234567')
+
+    def test_round_trip(self):
+        for text in ('hello', '{€} [~] ^|\\', 'x' * 160, 'שלום', 'hi 😀'):
+            pdus = sms.encode_submit('+1234', text)
+            self.assertEqual(len(pdus), 1)
+            msg = sms.decode_deliver(as_deliver(pdus[0][0]))
+            self.assertEqual((msg.number, msg.text, msg.concat), ('+1234', text, None))
+
+    def test_tpdu_length(self):
+        for pdu, tpdu_len in sms.encode_submit('+1234', 'x' * 400) + sms.encode_submit('+1', 'ש'):
+            self.assertEqual(len(bytes.fromhex(pdu)) - 1, tpdu_len)
+
+    def check_concat(self, text, parts, ref=7):
+        pdus = sms.encode_submit('+1234', text, ref)
+        self.assertEqual(len(pdus), parts)
+        msgs = [sms.decode_deliver(as_deliver(pdu)) for pdu, _ in pdus]
+        self.assertEqual([m.concat for m in msgs],
+                         [(ref, parts, seq) for seq in range(1, parts + 1)])
+        self.assertEqual(''.join(m.text for m in msgs), text)
+        return msgs
+
+    def test_concat_gsm7(self):
+        msgs = self.check_concat('x' * 161, 2)
+        self.assertEqual(len(msgs[0].text), sms.GSM7_CONCAT_SEPTETS)
+
+    def test_concat_keeps_escapes_whole(self):
+        # Two septets each, 76 of them fill 152 of 153
+        msgs = self.check_concat('€' * 100, 2)
+        self.assertEqual(len(msgs[0].text), 76)
+
+    def test_concat_ucs2(self):
+        msgs = self.check_concat('ש' * 71, 2)
+        self.assertEqual(len(msgs[0].text), sms.UCS2_CONCAT_UNITS)
+
+    def test_concat_keeps_surrogates_whole(self):
+        self.check_concat('a' * 66 + '😀' * 10, 2)
+
+    def test_ref_wraps(self):
+        pdus = sms.encode_submit('+1234', 'x' * 161, 0x101)
+        self.assertEqual(sms.decode_deliver(as_deliver(pdus[0][0])).concat, (1, 2, 1))
+
+
+class ConcatCacheTest(unittest.TestCase):
+    def test_out_of_order_parts(self):
+        cache = sms.ConcatCache()
+        self.assertIsNone(cache.add('+1234', '24/01/02', '10:00:01', 'world', (7, 2, 2), 4))
+        done = cache.add('+1234', '24/01/01', '10:00:00', 'hello ', (7, 2, 1), 3)
+        self.assertEqual(done, ('hello world', '+1234', '24/01/01', '10:00:00', [3, 4]))
+        self.assertEqual(len(cache), 0)
+
+    def test_untagged_parts(self):
+        # Direct mode parts have no storage slot
+        cache = sms.ConcatCache()
+        cache.add('+1234', '24/01/01', '10:00:00', 'hello ', (7, 2, 1))
+        done = cache.add('+1234', '24/01/01', '10:00:00', 'world', (7, 2, 2))
+        self.assertEqual(done[4], [])
+        self.assertEqual(cache.tags(), [])
+
+    def test_keep_until_discard(self):
+        cache = sms.ConcatCache()
+        cache.add('+1234', '24/01/01', '10:00:00', 'hello ', (7, 2, 1), keep=True)
+        done = cache.add('+1234', '24/01/01', '10:00:00', 'world', (7, 2, 2), keep=True)
+        self.assertEqual(done[0], 'hello world')
+        self.assertEqual(len(cache), 1)
+        # A repeated last part completes it again
+        self.assertEqual(cache.add('+1234', '', '', 'world', (7, 2, 2), keep=True)[0],
+                         'hello world')
+        cache.discard('+1234', (7, 2, 2))
+        self.assertEqual(len(cache), 0)
+
+    def test_keys_apart(self):
+        cache = sms.ConcatCache()
+        cache.add('+1234', '', '', 'a', (7, 2, 1), 1)
+        cache.add('+5678', '', '', 'b', (7, 2, 1), 2)
+        cache.add('+1234', '', '', 'c', (8, 2, 1), 3)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(sorted(cache.tags()), [1, 2, 3])
+
+    def test_bad_seq(self):
+        cache = sms.ConcatCache()
+        self.assertIsNone(cache.add('+1234', '', '', 'a', (7, 2, 3), 1))
+        self.assertEqual(cache.tags(), [])
+
+    def test_evict_expired(self):
+        cache = sms.ConcatCache(ttl=0)
+        cache.add('+1234', '24/01/01', '10:00:00', 'hello', (7, 3, 1), 5)
+        cache.add('+1234', '24/01/01', '10:00:00', 'there', (7, 3, 3))
+        self.assertEqual(cache.evict(), [(
+            'hello%sthere' % (sms.CONCAT_MISSING_PART, ), '+1234', '24/01/01', '10:00:00', [5]
+        )])
+        self.assertEqual(len(cache), 0)
+
+    def test_evict_oldest_beyond_bound(self):
+        cache = sms.ConcatCache(max_entries=2)
+        for ref in range(3):
+            cache.add('+1234', '', '', str(ref), (ref, 2, 1), ref)
+        evicted = cache.evict()
+        self.assertEqual([tags for _, _, _, _, tags in evicted], [[0]])
+        self.assertEqual(len(cache), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
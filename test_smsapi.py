@@ -0,0 +1,108 @@
+import os
+import json
+import asyncio
+import tempfile
+import unittest
+
+from smsapi import SmsApi
+
+
+class FakeSms:
+    def __init__(self, sms_id, number, text):
+        self.id = sms_id
+        self.number = number
+        self.text = text
+        self.sent = asyncio.get_running_loop().create_future()
+
+    def as_dict(self):
+        return {'id': self.id, 'number': self.number, 'text': self.text}
+
+
+class FakeModem:
+    def __init__(self):
+        self.sent = {}
+        self.error = None
+        self.fail = False
+
+    def send_sms(self, number, text, status_report=False):
+        if self.error:
+            raise self.error
+        outgoing = self.sent[len(self.sent) + 1] = FakeSms(len(self.sent) + 1, number, text)
+        if self.fail:
+            outgoing.sent.set_exception(RuntimeError('CMS ERROR'))
+        else:
+            outgoing.sent.set_result(True)
+        return outgoing
+
+    def get_sent_sms(self, sms_id):
+        return self.sent.get(sms_id)
+
+
+class SmsApiTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'sms.sock')
+        self.modem = FakeModem()
+        api = SmsApi(self.modem, self.path, lambda: {'gsm': {'network': {'ipv4': {}}}})
+        self.server = await asyncio.start_unix_server(api._handle, path=self.path)
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self._dir.cleanup()
+
+    async def request(self, method, path, body=b''):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        writer.write(b'%s %s HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s' % (
+            method.encode(), path.encode(), len(body), body
+        ))
+        res = await reader.read()
+        writer.close()
+
+        head, _, body = res.partition(b'\r\n\r\n')
+        return int(head.split()[1]), json.loads(body)
+
+    async def test_send(self):
+        status, res = await self.request('POST', '/sms', b'{"number": "+1234", "text": "hi"}')
+        self.assertEqual((status, res), (200, {'id': 1, 'number': '+1234', 'text': 'hi'}))
+        self.assertEqual(await self.request('GET', '/sms/1'), (200, res))
+
+    async def test_send_failed(self):
+        self.modem.fail = True
+        status, res = await self.request('POST', '/sms', b'{"number": "+1234", "text": "hi"}')
+        self.assertEqual((status, res['id']), (502, 1))
+
+    async def test_no_modem(self):
+        for error in (asyncio.QueueFull(), LookupError('No modem is up')):
+            self.modem.error = error
+            status, _ = await self.request('POST', '/sms', b'{"number": "+1234", "text": "hi"}')
+            self.assertEqual(status, 503)
+
+    async def test_bad_requests(self):
+        for body in (b'nope', b'{"number": "+1234"}', b'{"number": "abc", "text": "hi"}',
+                     b'{"number": "+1234", "text": ""}'):
+            status, _ = await self.request('POST', '/sms', body)
+            self.assertEqual(status, 400)
+        self.assertEqual(self.modem.sent, {})
+
+    async def test_routes(self):
+        self.assertEqual((await self.request('GET', '/sms'))[0], 405)
+        self.assertEqual((await self.request('POST', '/sms/1'))[0], 405)
+        self.assertEqual((await self.request('GET', '/sms/7'))[0], 404)
+        self.assertEqual((await self.request('GET', '/sms/x'))[0], 404)
+        self.assertEqual((await self.request('GET', '/other'))[0], 404)
+
+    async def test_status(self):
+        self.assertEqual(await self.request('GET', '/status'),
+                         (200, {'gsm': {'network': {'ipv4': {}}}}))
+        self.assertEqual((await self.request('POST', '/status'))[0], 405)
+
+    async def test_body_too_large(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        writer.write(b'POST /sms HTTP/1.1\r\nContent-Length: 1000000\r\n\r\n')
+        self.assertIn(b' 400 ', await reader.readline())
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import json
+import asyncio
+import threading
+import unittest
+import http.server
+from unittest import mock
+
+import tg
+
+
+class FakeTgApi(http.server.ThreadingHTTPServer):
+    '''
+    Answers sendMessage with the queued (status, body)s, then with 200s
+    '''
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeTgHandler)
+        self.replies = []
+        self.texts = []
+
+
+class FakeTgHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.texts.append(req['text'])
+        status, body = self.server.replies.pop(0) if self.server.replies else (200, {'ok': True})
+
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@mock.patch.object(tg, 'TG_COALESCE_DELAY', 0.05)
+@mock.patch.object(tg, 'TG_RETRY_MIN', 0.01)
+class TgForwarderTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.api = FakeTgApi()
+        threading.Thread(target=self.api.serve_forever, daemon=True).start()
+        self.tg = tg.TgForwarder('bot123', 42, 'http://127.0.0.1:%d' % (self.api.server_port, ))
+        self.task = asyncio.create_task(self.tg.run())
+
+    async def asyncTearDown(self):
+        self.task.cancel()
+        self.api.shutdown()
+        self.api.server_close()
+
+    async def test_coalesce_and_chunk(self):
+        msgs = [self.tg.forward('+1234', c * 2000) for c in 'abc']
+        self.assertEqual(await asyncio.gather(*msgs), [True] * 3)
+
+        # Two fit in one msg, the third goes in the next one
+        self.assertEqual(len(self.api.texts), 2)
+        self.assertTrue(all(len(text) <= tg.TG_MAX_TEXT for text in self.api.texts))
+        self.assertIn('a' * 2000, self.api.texts[0])
+        self.assertIn('b' * 2000, self.api.texts[0])
+        self.assertIn('c' * 2000, self.api.texts[1])
+
+    async def test_truncate(self):
+        await self.tg.forward('+1234', 'x' * (tg.TG_MAX_TEXT * 2), kind='Call')
+        self.assertEqual(len(self.api.texts[0]), tg.TG_MAX_TEXT)
+        self.assertTrue(self.api.texts[0].startswith('Call from: +1234\n'))
+
+    async def test_retry_server_error(self):
+        self.api.replies = [(500, {}), (502, {})]
+        self.assertTrue(await self.tg.forward('+1234', 'hi'))
+        self.assertEqual(len(self.api.texts), 3)
+
+    async def test_retry_after(self):
+        self.api.replies = [(429, {'ok': False, 'parameters': {'retry_after': 0.2}})]
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        self.assertTrue(await self.tg.forward('+1234', 'hi'))
+        self.assertGreaterEqual(loop.time() - start, 0.2)
+        self.assertEqual(len(self.api.texts), 2)
+
+    async def test_give_up(self):
+        self.api.replies = [(500, {})] * tg.TG_MAX_ATTEMPTS
+        with self.assertRaises(tg.TgError):
+            await self.tg.forward('+1234', 'hi')
+        self.assertEqual(len(self.api.texts), tg.TG_MAX_ATTEMPTS)
+
+    async def test_rejected(self):
+        self.api.replies = [(400, {'ok': False})]
+        with self.assertRaises(tg.TgError):
+            await self.tg.forward('+1234', 'hi')
+        self.assertEqual(len(self.api.texts), 1)
+
+    async def test_queue_overflow(self):
+        self.task.cancel()
+        with mock.patch.object(tg, 'TG_QUEUE_SIZE', 2):
+            fwd = tg.TgForwarder('bot123', 42, 'http://127.0.0.1:%d' % (self.api.server_port, ))
+        msgs = [fwd.forward('+1234', str(i)) for i in range(3)]
+
+        # The oldest one is dropped, and says so
+        with self.assertRaises(tg.TgError):
+            await msgs[0]
+        self.task = asyncio.create_task(fwd.run())
+        self.assertEqual(await asyncio.gather(*msgs[1:]), [True, True])
+        self.assertEqual(len(self.api.texts), 1)
+        self.assertNotIn('\n0', self.api.texts[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
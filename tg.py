@@ -1,21 +1,117 @@
-import requests
+import asyncio
 import logging
+import requests
+import concurrent.futures
+
 
+TG_API_BASE = 'https://api.telegram.org'
+TG_QUEUE_SIZE = 256
+TG_COALESCE_DELAY = 0.5
+# Telegram's limit for the text of a single message
+TG_MAX_TEXT = 4096
+TG_HTTP_TIMEOUT = 20
+TG_MAX_ATTEMPTS = 5
+TG_RETRY_MIN = 1
+TG_STATUS_TOO_MANY_REQUESTS = 429
 
 logger = logging.getLogger('TgForwarder')
 
 
+class TgError(Exception):
+    pass
+
+
 class TgForwarder:
-    def __init__(self, bot_auth, chat_id):
-        self._bot_auth = bot_auth
+    '''
+    Backup forwarder to a Telegram chat. forward() queues, and run() does the
+    sending over a pooled HTTP session, off the event loop. The future
+    forward() returns is done once Telegram has the msg, and fails if it
+    never will
+    '''
+    def __init__(self, bot_auth, chat_id, api_base=TG_API_BASE):
+        self._url = '%s/%s/sendMessage' % (api_base, bot_auth)
         self._chat_id = chat_id
+        self._queue = asyncio.Queue(TG_QUEUE_SIZE)
+        self._session = requests.Session()
+        # requests is blocking, and the session is only used from this thread
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
         logger.info('TG forwarder')
 
-    def forward(self, callerid, msg):
-        msg_text = 'SMS from: %s\n%s' % (callerid, msg)
-        requests.post(
-            'https://api.telegram.org/%s/sendMessage' % (self._bot_auth, ),
-            json={"chat_id": self._chat_id, "text": msg_text}
-        )
-        logger.info('Forwarded a msg to TG from %s' % (callerid, ))
+    def forward(self, callerid, msg, kind='SMS'):
+        msg_text = '%s from: %s\n%s' % (kind, callerid, msg)
+        if self._queue.full():
+            logger.warning('TG queue is full, dropping the oldest msg')
+            _, dropped = self._queue.get_nowait()
+            dropped.set_exception(TgError('Dropped, TG queue is full'))
+
+        sent = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((msg_text[:TG_MAX_TEXT], sent))
+        logger.info('Queued a msg to TG from %s' % (callerid, ))
+        return sent
+
+    def _post(self, text):
+        return self._session.post(self._url, json={'chat_id': self._chat_id, 'text': text},
+                                  timeout=TG_HTTP_TIMEOUT)
+
+    async def _send(self, text):
+        retry_delay = TG_RETRY_MIN
+        for attempt in range(TG_MAX_ATTEMPTS):
+            try:
+                res = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._post, text
+                )
+            except requests.RequestException as e:
+                logger.warning('TG send error: %r' % (e, ))
+            else:
+                if res.ok:
+                    return True
+                if res.status_code == TG_STATUS_TOO_MANY_REQUESTS:
+                    try:
+                        retry_delay = res.json()['parameters']['retry_after']
+                    except (ValueError, KeyError):
+                        pass
+                    logger.warning('TG rate limited, retry in %ds' % (retry_delay, ))
+                elif res.status_code < 500:
+                    logger.warning('TG rejected msg: %d %s' % (res.status_code, res.text))
+                    return False
+                else:
+                    logger.warning('TG server error: %d' % (res.status_code, ))
+
+            await asyncio.sleep(retry_delay)
+            retry_delay *= 2
+
+        return False
+
+    def _coalesce(self, first):
+        '''
+        Returns the (text, future)s that fit into one msg, and the one that
+        didn't, if any
+        '''
+        msgs = [first]
+        size = len(first[0])
+        while not self._queue.empty():
+            msg = self._queue.get_nowait()
+            if size + 2 + len(msg[0]) > TG_MAX_TEXT:
+                return msgs, msg
+            msgs.append(msg)
+            size += 2 + len(msg[0])
+        return msgs, None
+
+    async def run(self):
+        leftover = None
+        while True:
+            first = leftover or await self._queue.get()
+            # Let a burst pile up, and send it as one msg
+            await asyncio.sleep(TG_COALESCE_DELAY)
+            msgs, leftover = self._coalesce(first)
 
+            if await self._send('\n\n'.join(text for text, _ in msgs)):
+                logger.info('Forwarded %d msgs to TG' % (len(msgs), ))
+                for _, sent in msgs:
+                    if not sent.done():
+                        sent.set_result(True)
+            else:
+                logger.error('Gave up on %d msgs to TG' % (len(msgs), ))
+                for _, sent in msgs:
+                    if not sent.done():
+                        sent.set_exception(TgError('TG send failed'))